@@ -15,6 +15,8 @@ import os
 from time import gmtime
 import socket
 import threading
+import struct
+import uuid
 
 
 CONTENT_TYPE                    = "application/json"
@@ -22,6 +24,20 @@ CONTENT_TYPE                    = "application/json"
 USE_ZEPHYR_PROXY                = 1
 ZEPHYR_PROXY_IP_ADDRESS         = "127.0.0.1"
 ZEPHYR_PROXY_PORT_NUMBER        = 9999
+ZEPHYR_PROXY_PROTOCOL_VERSION   = 2             # 1 : JSON/base64 ##### delimited frames, 2 : binary frames negotiated by HELLO
+ZEPHYR_PROXY_HELLO_TIMEOUT      = 5             # older proxies never answer HELLO, fall back to protocol 1 after this many seconds
+ZEPHYR_PROXY_REPLY_TIMEOUT      = 120
+ZEPHYR_PROXY_BATCH_SIZE         = 500           # requests sent to the proxy in one BATCH frame
+ZEPHYR_PROXY_BUSY_RETRY_COUNT   = 10            # resends of a request the proxy answered BUSY before giving up
+ZEPHYR_PROXY_RETRY_COUNT        = 2             # resends of a GET, or of a write to a proxy keeping idempotency keys, the proxy did not answer
+
+FRAME_DELIMITER                 = "#####"
+FRAME_V2_MAGIC                  = "ZP"
+FRAME_V2_HEADER                 = struct.Struct("!2sBBHIHI")  # magic, method, flags, status, request id, meta length, body length
+FRAME_V2_METHODS                = {"GET": 1, "POST": 2, "PUT": 3, "EXIT": 4, "BATCH": 5}
+FRAME_V2_FLAG_JSON              = 0x01
+FRAME_V2_FLAG_ERROR             = 0x02          # reply generated by the proxy when zephyr did not answer
+FRAME_V2_FLAG_BUSY              = 0x04          # request refused by an overloaded proxy, resend it after the meta "retryAfter" seconds
 
 #ZEPHYR_DATA_FILE_LOC            = "/var/www/zephyr_dashboard/ZephyrData/"
 #ZEPHYR_CONFIG_PATH              = "/var/www/zephyr_dashboard/config.txt"
@@ -943,10 +959,11 @@ class CTestRepositoryTestCaseInfo:
 
 class CResponseObject:
 
-    def __init__(self, responseData, httpResponse):
+    def __init__(self, responseData, httpResponse, retryAfter = None):
 
         self.status_code            = httpResponse
         self._json                  = responseData
+        self.retry_after            = retryAfter
 
     def json(self):
 
@@ -974,7 +991,7 @@ class CUDPSocketClass:
         while (True):
             data, addr = self._sock.recvfrom(8092)
             jsonData = json.loads(data)
-            CompleteZephyrResponseLength = int(jsonData["len"])
+            CompleteZephyrResponseLength = int(jsonData["len"] or 0)
             payload = payload + str(jsonData["payload"])
             payloadLength = len(payload)
             status_code = int(jsonData["httpStatusCode"])
@@ -990,17 +1007,141 @@ class CUDPSocketClass:
 
         return responseObject
 
-class CTCPSocketClass:
+class CPendingRequest:
+    '''
+    This class holds one protocol 2 request waiting for the reply frame carrying its request id
+    '''
+    def __init__(self, requestId):
+
+        self.mRequestId = requestId
+        self.mEvent = threading.Event()
+        self.mReply = None
 
+    def complete(self, reply):
+
+        self.mReply = reply
+        self.mEvent.set()
+
+class CTCPSocketClass:
+    '''
+    Connection to the zephyr proxy. Under protocol 2 every request carries its own request id and a reader
+    thread hands reply frames to the waiting caller, so several threads can share one connection and
+    replies may arrive in any order
+    '''
     def __init__(self, pIPAddress, pPortNumber):
         self.mIPAddress = pIPAddress
         self.mPortNumber = pPortNumber
         self.mData = ''
+        self.mNextRequestId = 0
+        self.mSendLock = threading.Lock()
+        self.mPendingLock = threading.Lock()
+        self.mPendingRequests = {}
+        self.mReaderThread = None
+        self.mIdempotentWrites = False
+        self.mBatchRequests = False
+        self.mConnectLock = threading.Lock()
+        self.connect()
+
+    def connect(self):
+        '''
+        Open the connection to the proxy, negotiate its framing and start the protocol 2 reader thread
+        :return:
+        '''
+        self.mData = ''
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.mIPAddress, self.mPortNumber))
+        self.mProtocolVersion = self.negotiateProtocol()
+        if self.mProtocolVersion >= 2:
+            self.sock.settimeout(None)
+            self.mReaderThread = threading.Thread(target=self.readReplies, name="ZephyrProxyReader")
+            self.mReaderThread.daemon = True
+            self.mReaderThread.start()
+
+    def reconnect(self):
+        '''
+        Replace a connection whose replies can no longer be matched to requests : a protocol 1 stream after a reply
+        timeout, where the late reply would be read as the next one, or a protocol 2 connection whose reader stopped.
+        A protocol 2 connection with a running reader is kept, its late replies are dropped by request id
+        :return:
+        '''
+        with self.mConnectLock:
+            if self.mProtocolVersion >= 2 and self.mReaderThread is not None and self.mReaderThread.is_alive():
+                return
+            sendLogToStdout("Reconnecting to Zephyr proxy %s:%s" % (self.mIPAddress, self.mPortNumber))
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.connect()
+
+    def negotiateProtocol(self):
+        '''
+        Offer ZEPHYR_PROXY_PROTOCOL_VERSION to the proxy with a HELLO request. Writes are only resent to a proxy whose
+        HELLO reply says it keeps idempotency keys, an older one would apply them twice, and BATCH requests are only
+        sent to a proxy whose reply says it understands them
+        :return: framing version to use on this connection
+        '''
+        self.mIdempotentWrites = False
+        self.mBatchRequests = False
+        if ZEPHYR_PROXY_PROTOCOL_VERSION < 2:
+            return 1
+        try:
+            self.sock.send(json.dumps({"url": "", "method": "HELLO", "data": "", "protocol": ZEPHYR_PROXY_PROTOCOL_VERSION}) + FRAME_DELIMITER)
+            self.sock.settimeout(ZEPHYR_PROXY_HELLO_TIMEOUT)
+            while FRAME_DELIMITER not in self.mData:
+                recvData = self.sock.recv(4096)
+                if not recvData:
+                    break
+                self.mData = self.mData + recvData
+            helloData, self.mData = self.mData.split(FRAME_DELIMITER, 1)
+            helloReply = json.loads(helloData)
+            protocolVersion = int(helloReply.get("protocol", 1))
+            self.mIdempotentWrites = helloReply.get("idempotency") is True
+            self.mBatchRequests = protocolVersion >= 2 and helloReply.get("batch") is True
+        except Exception as exp:
+            sendLogToStdout("Zephyr proxy did not negotiate framing, using protocol 1 : %s" % exp)
+            protocolVersion = 1
+        sendLogToStdout("Zephyr proxy protocol version : %s" % protocolVersion)
+        return protocolVersion
 
     def processTCPRequest(self, requestObject):
 
+        responseObject = self.retryWhileBusy(requestObject, self.sendTCPRequestOnce(requestObject))
+        retryCount = 0
+        while responseObject is None and requestObject.IsRetrySafe(self.mIdempotentWrites) and retryCount < ZEPHYR_PROXY_RETRY_COUNT:
+            retryCount += 1
+            sendLogToStdout("No reply from Zephyr proxy, resending %s %s" % (requestObject._httpMethod, requestObject._requestURL))
+            try:
+                self.reconnect()
+            except socket.error as exp:
+                sendLogToStdout("ERROR: Unable to reconnect to Zephyr proxy : %s" % exp)
+                continue
+            responseObject = self.retryWhileBusy(requestObject, self.sendTCPRequestOnce(requestObject))
+        return responseObject
+
+    def sendTCPRequestOnce(self, requestObject):
+
+        if self.mProtocolVersion >= 2:
+            return self.processTCPRequestV2(requestObject)
+        return self.processTCPRequestV1(requestObject)
+
+    def retryWhileBusy(self, requestObject, responseObject):
+        '''
+        Resend a request the proxy answered BUSY once its retry after delay has passed
+        :param requestObject: CRequestClass
+        :param responseObject: first reply of the request
+        :return: CResponseObject, the last BUSY reply after ZEPHYR_PROXY_BUSY_RETRY_COUNT resends
+        '''
+        retryCount = 0
+        while responseObject is not None and responseObject.retry_after is not None and retryCount < ZEPHYR_PROXY_BUSY_RETRY_COUNT:
+            retryCount += 1
+            sendLogToStdout("Zephyr proxy is busy, resending %s %s in %s seconds" % (requestObject._httpMethod, requestObject._requestURL, responseObject.retry_after))
+            time.sleep(responseObject.retry_after)
+            responseObject = self.sendTCPRequestOnce(requestObject)
+        return responseObject
+
+    def processTCPRequestV1(self, requestObject):
+
         try:
             self.sock.send(requestObject.GetJSONPayload() + "#####")
             sendLogToStdout("Sending (%s) to : %s" %(requestObject.GetJSONPayload(), self.sock.getsockname()))
@@ -1008,34 +1149,199 @@ class CTCPSocketClass:
             sendLogToStdout("Response Data : %s" % recvData)
 
             jsonData = json.loads(recvData)
-            CompleteZephyrResponseLength = int(jsonData["len"])
+            CompleteZephyrResponseLength = int(jsonData["len"] or 0)
             payload = str(jsonData["payload"])
             payloadLength = len(payload)
             status_code = int(jsonData["httpStatusCode"])
 
-            decodedMessgae = json.loads(base64.decodestring(payload))
+            if "error" in jsonData:
+                sendLogToStdout("ERROR: Zephyr proxy answered %s : %s" % (status_code, jsonData["error"]))
+
+            # the proxy sends a payload for 200 replies only
+            decodedMessgae = json.loads(base64.decodestring(payload)) if payloadLength > 0 else None
 
             sendLogToStdout(
                     "Zephyr Response for GET request is : %s and response message is : %s" % (
             status_code, decodedMessgae))
 
-            responseObject = CResponseObject(decodedMessgae, status_code)
+            responseObject = CResponseObject(decodedMessgae, status_code, jsonData.get("retryAfter"))
 
             return responseObject
         except Exception as exp:
-            sendLogToStdout("Exception in CTCPSocketClass::processTCPRequest : %s " % exp)
+            sendLogToStdout("Exception in CTCPSocketClass::processTCPRequestV1 : %s " % exp)
             exc_type, exc_obj, exc_tb = sys.exc_info()
             sendLogToStdout("%s %s %s" %(exc_type, exc_obj, exc_tb.tb_lineno))
             return None
 
+    def processTCPRequestV2(self, requestObject):
+        '''
+        Send one request as a protocol 2 binary frame and wait for its reply
+        :param requestObject: CRequestClass
+        :return: CResponseObject
+        '''
+        return self.waitTCPResponse(self.sendTCPRequest(requestObject))
+
+    def processTCPRequests(self, requestObjects):
+        '''
+        Send all requests before waiting for any reply, the proxy works on them concurrently
+        :param requestObjects: list of CRequestClass
+        :return: list of CResponseObject in request order
+        '''
+        if self.mProtocolVersion < 2:
+            return [self.processTCPRequest(requestObject) for requestObject in requestObjects]
+        pendingRequests = [self.sendTCPRequest(requestObject) for requestObject in requestObjects]
+        responseObjects = []
+        for requestObject, pendingRequest in zip(requestObjects, pendingRequests):
+            responseObject = self.retryWhileBusy(requestObject, self.waitTCPResponse(pendingRequest))
+            if responseObject is None and requestObject.IsRetrySafe(self.mIdempotentWrites):
+                responseObject = self.processTCPRequest(requestObject)
+            responseObjects.append(responseObject)
+        return responseObjects
+
+    def processTCPBatch(self, requestObjects, priority = None):
+        '''
+        Send requests to the proxy in BATCH frames of ZEPHYR_PROXY_BATCH_SIZE, the proxy runs their items concurrently.
+        Requests to a proxy which did not announce BATCH support and those of an unanswered BATCH are sent one by one
+        :param requestObjects: list of CRequestClass
+        :param priority: queue lane of the BATCH request, also used by items without their own priority
+        :return: list of CResponseObject in request order, None for items without reply
+        '''
+        responseObjects = []
+        for index in range(0, len(requestObjects), ZEPHYR_PROXY_BATCH_SIZE):
+            batchObjects = requestObjects[index:index + ZEPHYR_PROXY_BATCH_SIZE]
+            batchResponse = None
+            if self.mBatchRequests:
+                batchResponse = self.processTCPRequest(CRequestClass("", "BATCH", json.dumps([requestObject.GetBatchItem() for requestObject in batchObjects]), priority))
+            if batchResponse is None:
+                if self.mBatchRequests:
+                    sendLogToStdout("No reply from Zephyr proxy for BATCH of %s requests, sending them one by one" % len(batchObjects))
+                for requestObject in batchObjects:
+                    if requestObject._priority is None:
+                        requestObject._priority = priority
+                responseObjects.extend(self.processTCPRequests(batchObjects))
+                continue
+            if batchResponse.status_code != 200 or not isinstance(batchResponse.json(), list):
+                sendLogToStdout("ERROR: BATCH of %s requests failed" % len(batchObjects))
+                responseObjects.extend([None] * len(batchObjects))
+                continue
+            for itemResponse in batchResponse.json():
+                responseObjects.append(CResponseObject(itemResponse.get("body"), int(itemResponse["httpStatusCode"])))
+        return responseObjects
 
+    def sendTCPRequest(self, requestObject):
+        '''
+        Send one protocol 2 request without waiting for its reply
+        :param requestObject: CRequestClass
+        :return: CPendingRequest to pass to waitTCPResponse, None when sending failed
+        '''
+        try:
+            with self.mPendingLock:
+                # request id 0 asks the proxy for in order replies, never use it here
+                self.mNextRequestId = (self.mNextRequestId % 0xFFFFFFFF) + 1
+                pendingRequest = CPendingRequest(self.mNextRequestId)
+                self.mPendingRequests[pendingRequest.mRequestId] = pendingRequest
+            with self.mSendLock:
+                self.sock.sendall(requestObject.GetBinaryFrame(pendingRequest.mRequestId))
+            sendLogToStdout("Sending frame %s (%s %s) to : %s" %(pendingRequest.mRequestId, requestObject._httpMethod, requestObject._requestURL, self.sock.getsockname()))
+            return pendingRequest
+        except Exception as exp:
+            sendLogToStdout("Exception in CTCPSocketClass::sendTCPRequest : %s " % exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            sendLogToStdout("%s %s %s" %(exc_type, exc_obj, exc_tb.tb_lineno))
+            return None
+
+    def waitTCPResponse(self, pendingRequest):
+        '''
+        Wait for the reply frame of a request sent by sendTCPRequest
+        :param pendingRequest: CPendingRequest
+        :return: CResponseObject, None on timeout or lost connection
+        '''
+        if pendingRequest is None:
+            return None
+        try:
+            pendingRequest.mEvent.wait(ZEPHYR_PROXY_REPLY_TIMEOUT)
+            with self.mPendingLock:
+                self.mPendingRequests.pop(pendingRequest.mRequestId, None)
+            if pendingRequest.mReply is None:
+                sendLogToStdout("No reply from Zephyr proxy for frame %s" % pendingRequest.mRequestId)
+                return None
+
+            methodCode, flags, status_code, requestId, meta, body = pendingRequest.mReply
+
+            decodedMessgae = None
+            if len(body) > 0 and (flags & FRAME_V2_FLAG_JSON):
+                decodedMessgae = json.loads(body)
+            if flags & FRAME_V2_FLAG_ERROR:
+                sendLogToStdout("ERROR: Zephyr proxy answered %s : %s" % (status_code, decodedMessgae))
+            retryAfter = json.loads(meta).get("retryAfter") if (flags & FRAME_V2_FLAG_BUSY) else None
+
+            sendLogToStdout("Zephyr Response for frame %s is : %s and response length is : %s" % (requestId, status_code, len(body)))
+
+            return CResponseObject(decodedMessgae, status_code, retryAfter)
+        except Exception as exp:
+            sendLogToStdout("Exception in CTCPSocketClass::waitTCPResponse : %s " % exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            sendLogToStdout("%s %s %s" %(exc_type, exc_obj, exc_tb.tb_lineno))
+            return None
+
+    def readReplies(self):
+        '''
+        Reader thread : hand every protocol 2 reply frame to the request waiting for its request id
+        :return:
+        '''
+        try:
+            while True:
+                reply = self.recvFrameV2()
+                with self.mPendingLock:
+                    pendingRequest = self.mPendingRequests.pop(reply[3], None)
+                if pendingRequest is None:
+                    sendLogToStdout("Dropping Zephyr proxy reply for unknown frame %s" % reply[3])
+                    continue
+                pendingRequest.complete(reply)
+        except Exception as exp:
+            sendLogToStdout("Zephyr proxy reader stopped : %s " % exp)
+        # wake every waiting caller, their replies will never arrive
+        with self.mPendingLock:
+            pendingRequests = self.mPendingRequests.values()
+            self.mPendingRequests = {}
+        for pendingRequest in pendingRequests:
+            pendingRequest.complete(None)
+
+    def recvExact(self, length):
+        '''
+        Returns exactly length bytes, starting with data left over in self.mData
+        :param length:
+        :return:
+        '''
+        chunks = [self.mData]
+        received = len(self.mData)
+        while received < length:
+            recvData = self.sock.recv(max(length - received, 65536))
+            if not recvData:
+                raise socket.error("Zephyr proxy closed the connection")
+            chunks.append(recvData)
+            received += len(recvData)
+        data = "".join(chunks)
+        self.mData = data[length:]
+        return data[:length]
+
+    def recvFrameV2(self):
+        '''
+        Read one protocol 2 frame
+        :return: method code, flags, status, request id, meta and body
+        '''
+        magic, methodCode, flags, status, requestId, metaLength, bodyLength = FRAME_V2_HEADER.unpack(self.recvExact(FRAME_V2_HEADER.size))
+        if magic != FRAME_V2_MAGIC:
+            raise ValueError("Invalid protocol 2 frame received from Zephyr proxy")
+        data = self.recvExact(metaLength + bodyLength)
+        return methodCode, flags, status, requestId, data[:metaLength], data[metaLength:]
 
     def recvSocketData(self):
 
         lResponseData = ""
         try:
             while True:
-                self.sock.settimeout(120)
+                self.sock.settimeout(ZEPHYR_PROXY_REPLY_TIMEOUT)
 
                 recvData = self.sock.recv(1048576)
 
@@ -1081,25 +1387,80 @@ class CTCPSocketClass:
     def close(self):
 
         sendLogToStdout("Closing client TCP Connection")
-        msg = json.dumps("exit")
-        self.sock.send(msg)
+        if self.mProtocolVersion >= 2:
+            msg = FRAME_V2_HEADER.pack(FRAME_V2_MAGIC, FRAME_V2_METHODS["EXIT"], 0, 0, 0, 0, 0)
+        else:
+            msg = json.dumps("exit")
+        with self.mSendLock:
+            self.sock.send(msg)
 
+        if self.mReaderThread is not None:
+            # shutdown wakes the reader thread blocked in recv
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
         self.sock.close()
 
 class CRequestClass:
 
-    def __init__(self, requestURL, httpMethod, httpPayload = ""):
-
+    def __init__(self, requestURL, httpMethod, httpPayload = "", priority = None):
+        '''
+        :param requestURL:
+        :param httpMethod:
+        :param httpPayload:
+        :param priority: zephyr proxy queue lane ("write", "interactive" or "bulk"), None lets the proxy classify the request
+        '''
         self._requestURL                = requestURL
         self._httpMethod                = httpMethod
         self._httpPayload               = httpPayload
+        self._priority                  = priority
+        # the proxy answers resends of a write with the reply of the first one instead of applying it again
+        self._idempotencyKey            = uuid.uuid4().hex if httpMethod in ["POST", "PUT"] else None
+
+    def IsRetrySafe(self, idempotentWrites):
+        '''
+        :param idempotentWrites: the proxy answered HELLO saying it keeps idempotency keys
+        '''
+        return self._httpMethod == "GET" or (idempotentWrites and self._idempotencyKey is not None)
+
+    def GetDeadline(self):
+        '''
+        Returns the epoch time after which the caller stops waiting for the reply, the proxy drops the request once it has passed
+        '''
+        return time.time() + ZEPHYR_PROXY_REPLY_TIMEOUT
 
     def GetJSONPayload(self):
 
-        values = {"url" : self._requestURL, "method" : self._httpMethod, "data" : "" if (self._httpPayload is None) else (base64.b64encode(self._httpPayload)) }
+        values = self.GetBatchItem()
+        values["deadline"] = self.GetDeadline()
         sendLogToStdout("Sending JSON values : %s" %values)
         return json.dumps(values)
 
+    def GetBatchItem(self):
+
+        values = {"url" : self._requestURL, "method" : self._httpMethod, "data" : "" if (self._httpPayload is None) else (base64.b64encode(self._httpPayload)) }
+        if self._priority is not None:
+            values["priority"] = self._priority
+        if self._idempotencyKey is not None:
+            values["idempotencyKey"] = self._idempotencyKey
+        return values
+
+    def GetBinaryFrame(self, requestId):
+        '''
+        Returns the request as a protocol 2 frame : fixed header, JSON meta block with the url and the raw body
+        :param requestId:
+        :return:
+        '''
+        metaValues = {"url": self._requestURL, "deadline": self.GetDeadline()}
+        if self._priority is not None:
+            metaValues["priority"] = self._priority
+        if self._idempotencyKey is not None:
+            metaValues["idempotencyKey"] = self._idempotencyKey
+        meta = json.dumps(metaValues)
+        body = "" if (self._httpPayload is None) else self._httpPayload
+        return FRAME_V2_HEADER.pack(FRAME_V2_MAGIC, FRAME_V2_METHODS[self._httpMethod], 0, 0, requestId, len(meta), len(body)) + meta + body
+
 ###########################################Execution  Classes##########################################################################
 class CHttpClass:
     '''
@@ -1120,6 +1481,15 @@ class CHttpClass:
         self._httpGetRequestCountStats      = 0
         self._httpPutRequestCountStats      = 0
         self._httpPostRequestCountStats     = 0
+        self._requestPriority               = None
+
+    def setRequestPriority(self, priority):
+        '''
+        Zephyr proxy queue lane of the following requests, e.g. "bulk" for metric crawls
+        :param priority: "write", "interactive", "bulk" or None to let the proxy classify each request
+        :return:
+        '''
+        self._requestPriority = priority
 
     def getHttpSession(self):
         '''
@@ -1144,12 +1514,27 @@ class CHttpClass:
             response = self.getHttpSession().get(requestURL)
         else:
             #Code which will use zephyr proxy module to get a response
-            request = CRequestClass(requestURL, "GET")
+            request = CRequestClass(requestURL, "GET", priority = self._requestPriority)
             response = self._tcpSession.processTCPRequest(request)
         sendLogToStdout("CHttpClass : Get Request count : %s" %self._httpGetRequestCountStats)
         sendLogToStdout("CHttpClass : get Response : %s" % response.json())
         return response
 
+    def getBatch(self, requestURLs):
+        '''
+        Process many get http methods, through the zephyr proxy they cost one round trip per BATCH frame
+        :param requestURLs:
+        :return: list of responses in requestURLs order, None for requests without reply
+        '''
+        sendLogToStdout("CHttpClass : getBatch : %s urls" %len(requestURLs))
+        self._httpGetRequestCountStats = self._httpGetRequestCountStats + len(requestURLs)
+        if USE_ZEPHYR_PROXY == 0:
+            responses = [self.getHttpSession().get(requestURL) for requestURL in requestURLs]
+        else:
+            responses = self._tcpSession.processTCPBatch([CRequestClass(requestURL, "GET") for requestURL in requestURLs], self._requestPriority)
+        sendLogToStdout("CHttpClass : Get Request count : %s" %self._httpGetRequestCountStats)
+        return responses
+
     def put(self, putURL, values=None):
         '''
         Process put http method
@@ -1164,7 +1549,7 @@ class CHttpClass:
             response = self.getHttpSession().put(putURL, data = values)
         else:
             #Code which will use zephyr proxy module to get a response
-            request = CRequestClass(putURL, "PUT", values)
+            request = CRequestClass(putURL, "PUT", values, self._requestPriority)
             response = self._tcpSession.processTCPRequest(request)
         sendLogToStdout("CHttpClass : Put Request count : %s" %self._httpPutRequestCountStats)
         sendLogToStdout("CHttpClass : put Response : %s" % response.json())
@@ -1184,7 +1569,7 @@ class CHttpClass:
             response = self.getHttpSession().post(postURL, data=values)
         else:
             #Code which will use zephyr proxy module to get a response
-            request = CRequestClass(postURL, "POST", values)
+            request = CRequestClass(postURL, "POST", values, self._requestPriority)
             response = self._tcpSession.processTCPRequest(request)
         sendLogToStdout("CHttpClass : Post Request count : %s" %self._httpPostRequestCountStats)
         sendLogToStdout("CHttpClass : post Response : %s" % response.json())
@@ -2281,15 +2666,46 @@ class CZephyr:
         :return:
         '''
 
-        testCaseExecutionInfoObj    = None
-        testStepsListObj            = []
+        requestURL = self.getTestCaseStepsURL(testCaseZephyrId, isfetchstepversion)
+        response = (self.getZephyrSession()).get(requestURL)
+        return self.parseTestCaseSteps(response, requestURL)
+
+    def getAllTestCaseSteps(self, testCaseZephyrIds, isfetchstepversion = True):
+        '''
+        Fetch test steps of many test cases with one batched request
+        :param testCaseZephyrIds:
+        :param isfetchstepversion:
+        :return: dictionary of test case zephyr id and its CTestCaseExecutionInfo
+        '''
+        testCaseZephyrIds = list(set(testCaseZephyrIds))
+        requestURLs = [self.getTestCaseStepsURL(testCaseZephyrId, isfetchstepversion) for testCaseZephyrId in testCaseZephyrIds]
+        responses = (self.getZephyrSession()).getBatch(requestURLs)
+        testCaseStepObjDict = {}
+        for testCaseZephyrId, requestURL, response in zip(testCaseZephyrIds, requestURLs, responses):
+            testCaseStepObjDict[testCaseZephyrId] = self.parseTestCaseSteps(response, requestURL)
+        return testCaseStepObjDict
+
+    def getTestCaseStepsURL(self, testCaseZephyrId, isfetchstepversion = True):
+
         rep = {"TEST_CASE_ZEPHYR_ID": str(testCaseZephyrId), "IS_FETCH_VERSION": "true" if isfetchstepversion is True else "false", "TEST_CASE_VERION_ID": str(testCaseZephyrId)}
         rep = dict((re.escape(k), v) for k, v in rep.iteritems())
         pattern = re.compile("|".join(rep.keys()))
         finalPathURL = pattern.sub(lambda m: rep[re.escape(m.group(0))], FETCH_TEST_CASE_STEPS)
 
-        requestURL = self._zephyrBaseURL + finalPathURL
-        response = (self.getZephyrSession()).get(requestURL)
+        return self._zephyrBaseURL + finalPathURL
+
+    def parseTestCaseSteps(self, response, requestURL):
+        '''
+        :param response: reply of a FETCH_TEST_CASE_STEPS request
+        :param requestURL:
+        :return: CTestCaseExecutionInfo, None when the request failed
+        '''
+        testCaseExecutionInfoObj    = None
+        testStepsListObj            = []
+
+        if response is None:
+            sendLogToStdout("ERROR: getTestCaseSteps: no response for GET request : %s" % requestURL)
+            return testCaseExecutionInfoObj
 
         sendLogToStdout("getTestCaseSteps: response.status_code : %s" % response.status_code)
         if (response.status_code != 200):
@@ -2349,6 +2765,8 @@ class CZephyr:
 
         jsonContent  = responseJson["results"]
 
+        testCaseStepObjDict = self.getAllTestCaseSteps([self.GetJSONTagValue(testResult["tcrTreeTestcase"]["testcase"], 'id') for testResult in jsonContent])
+
         for testResult in jsonContent:
 
             testCaseJson = testResult["tcrTreeTestcase"]["testcase"]
@@ -2440,7 +2858,7 @@ class CZephyr:
                                                     self.GetJSONTagValue(defectItem, 'testResults'))
                     defectList.append(defectDetail)
 
-            testCaseStepObj = self.getTestCaseSteps(testCaseObj.id)
+            testCaseStepObj = testCaseStepObjDict.get(testCaseObj.id)
 
             executionDetailObj   = CExecutionDetail(self.GetJSONTagValue(testResult, 'status'), self.GetJSONTagValue(testResult, 'lastModifiedOn'),
                                                     self.GetJSONTagValue(testResult, 'attachementCount'), tcrTreeTestCaseObj,
@@ -2476,6 +2894,8 @@ class CZephyr:
 
         jsonContent  = responseJson["results"]
 
+        testCaseStepObjDict = self.getAllTestCaseSteps([self.GetJSONTagValue(testResult["tcrTreeTestcase"]["testcase"], 'id') for testResult in jsonContent])
+
         for testResult in jsonContent:
             testCaseJson = testResult["tcrTreeTestcase"]["testcase"]
             customFieldValueJson = testCaseJson["customFieldValues"]
@@ -2574,7 +2994,7 @@ class CZephyr:
                                                  self.GetJSONTagValue(defectItem, 'testResults'))
                     defectList.append(defectDetail)
 
-            testCaseStepObj = self.getTestCaseSteps(testCaseObj.id)
+            testCaseStepObj = testCaseStepObjDict.get(testCaseObj.id)
 
             executionDetailObj = CExecutionDetail(self.GetJSONTagValue(testResult, 'status'),
                                                   self.GetJSONTagValue(testResult, 'lastModifiedOn'),
@@ -3143,6 +3563,9 @@ class CZephyrMetricsThread(threading.Thread):
         sendLogToStdout(datetime.datetime.now())
         zephyrObj = CZephyr(cfg, self.mZephyrProjectName)
 
+        # Metric crawls must not delay the result updates of test runners sharing the zephyr proxy
+        zephyrObj.getZephyrSession().setRequestPriority("bulk")
+
         # Update the context in zephyrObj object
         zephyrObj.updateProjectContext(self.mZephyrProjectName)
 
@@ -1,133 +1,2583 @@
 import sys
 import socket
 import threading
-import Queue
 import json
 import base64
 import requests
+import requests.adapters
+import urllib3
 from time import gmtime
 import datetime
 import os
 import time
+import select
+import struct
+import re
+import collections
+import random
+import sqlite3
+import hashlib
+import Queue
 
 SERVER_LISTEN_PORT          = 9999
 CLIENT_CONNECTION_LIMIT     = 500
-Queue_Container             = Queue.Queue()
+SERVER_ENGINE               = "threaded"        # "threaded" : one ThreadDelegate per client, "eventloop" : single select loop
+EVENT_LOOP_POLL_TIMEOUT     = 1.0
+SOCKET_RECV_SIZE            = 65536
+FRAME_DELIMITER             = "#####"
+FRAME_EXIT_MESSAGE          = "\"exit\""          # protocol 1 close message, sent without delimiter
+FRAME_PROTOCOL_VERSION      = 2                 # highest framing version offered to clients sending a HELLO request
+FRAME_V2_MAGIC              = "ZP"
+FRAME_V2_HEADER             = struct.Struct("!2sBBHIHI")  # magic, method, flags, status, request id, meta length, body length
+FRAME_V2_METHODS            = {"GET": 1, "POST": 2, "PUT": 3, "EXIT": 4, "BATCH": 5}
+FRAME_V2_METHOD_NAMES       = dict((code, name) for name, code in FRAME_V2_METHODS.items())
+FRAME_V2_FLAG_JSON          = 0x01              # body is a JSON document
+FRAME_V2_FLAG_ERROR         = 0x02              # reply generated by the proxy, the JSON body carries the error message
+FRAME_V2_FLAG_BUSY          = 0x04              # request rejected by the proxy, resend it after the meta "retryAfter" seconds
+MAX_FRAME_BYTES             = 64 * 1024 * 1024  # larger client frames close the connection instead of being buffered
+DISPATCHER_WORKER_COUNT     = 16                # upper bound of concurrent zephyr calls, the adaptive limit decides how many are used
+BATCH_MAX_PARALLELISM       = 8                 # items of one BATCH request queued or in flight against zephyr at once
+BATCH_ITEM_METHODS          = ["GET", "POST", "PUT"]
+UPSTREAM_POOL_MAX_HOSTS     = 4                 # zephyr hosts whose connection pools are kept
+UPSTREAM_POOL_MAX_PER_HOST  = 16                # connections per zephyr host, more concurrent calls wait for a free one
+UPSTREAM_POOL_IDLE_TIMEOUT  = 30                # seconds an unused keep-alive connection is kept open
+RATE_LIMIT_ENABLED          = True
+RATE_LIMIT_TOKENS_PER_SECOND = 50.0             # zephyr calls per second over all urls
+RATE_LIMIT_BURST            = 50
+#(url part, calls per second, burst) : heavy url families get their own budget inside the global one
+RATE_LIMIT_FAMILY_RULES     = [("/execution?",      10.0,   10),
+                               ("/testcase/tree/",  5.0,    5),
+                               ("/advancesearch/",  2.0,    2)]
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_INITIAL = 4                # concurrent zephyr calls allowed at startup
+ADAPTIVE_CONCURRENCY_MIN    = 1
+ADAPTIVE_CONCURRENCY_MAX    = 16
+ADAPTIVE_CONCURRENCY_WINDOW = 20                # completed calls between two limit adjustments
+ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE = 2.0    # back off when the window p90 latency exceeds this multiple of the baseline p90
+ADAPTIVE_CONCURRENCY_ERROR_RATIO = 0.1          # back off when more of the window calls fail with 5xx or no response
+ADAPTIVE_CONCURRENCY_BACKOFF = 0.75
+UPSTREAM_TIMEOUT            = 20                # seconds
+UPSTREAM_GET_RETRY_COUNT    = 3                 # GETs are idempotent and retried, writes never are
+UPSTREAM_RETRY_BASE_BACKOFF = 0.2               # seconds, doubled every retry and fully jittered
+UPSTREAM_RETRY_MAX_BACKOFF  = 5.0
+UPSTREAM_RETRY_STATUS_CODES = [502, 503, 504]
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5           # consecutive failed zephyr calls opening the circuit
+CIRCUIT_BREAKER_OPEN_SECONDS = 10               # requests fail fast this long before one trial call is let through
+HEDGING_ENABLED             = False             # send a second identical GET when the first one is slower than usual
+HEDGE_PERCENTILE            = 95                # latency percentile of the url template after which a GET is hedged
+HEDGE_MIN_DELAY             = 0.05              # seconds, lower bound of the hedge delay
+HEDGE_MAX_RATIO             = 0.05              # hedges per GET in the long run
+HEDGE_BURST                 = 10                # hedges allowed at once before the ratio applies
+HEDGE_LATENCY_WINDOW        = 200               # latest GET latencies kept per url template
+HEDGE_MIN_SAMPLES           = 20                # latencies needed before a url template is hedged
+TCP_KEEPALIVE_IDLE          = 60                # seconds of silence before the kernel probes a client
+TCP_KEEPALIVE_INTERVAL      = 10
+TCP_KEEPALIVE_COUNT         = 5
+REQUEST_LANES               = ["write", "interactive", "bulk"]  # queue lanes in priority order
+REQUEST_LANE_MAX_WAIT       = {"interactive": 0.5, "bulk": 1.0}  # seconds a non empty lane may go unserved behind higher lanes
+BULK_URL_PARTS              = ["/testcase/tree/", "/testcasetree?", "/testcase/count", "/advancesearch/"]
+FAIR_QUEUE_QUANTUM          = 1                 # requests a client connection may send per round robin turn within a lane
+FAIR_QUEUE_COST_BYTES       = 64 * 1024         # every started block of request payload costs one more request
+REQUEST_QUEUE_MAX_SIZE      = 10000             # queued requests of all clients, further requests are answered BUSY
+CONNECTION_MAX_IN_FLIGHT    = 1000              # queued or running requests of one client connection
+QUEUE_FULL_RETRY_AFTER      = 1.0               # seconds, retry hint of BUSY replies sent when the queue is full
+CONNECTION_BUSY_RETRY_AFTER = 0.2               # seconds, retry hint of BUSY replies sent when the connection is at its cap
+BUSY_REPLY_QUEUE_MAX_SIZE   = 1000              # BUSY replies of all clients waiting to be sent, a client refused beyond it is disconnected
+CONNECTION_MAX_BUSY_REPLIES = 100               # BUSY replies of one connection waiting to be sent, a client not reading them is disconnected
 USERNAME                    = <ZEPHYR_USERNAME>
 PASSWORD                    = <ZEPHYR_PASSWORD>
 CONTENT_TYPE                = "application/json"
 exitFlag                    = False
 threadList                  = []
 
+RESPONSE_CACHE_ENABLED      = True
+RESPONSE_CACHE_MAX_BYTES    = 256 * 1024 * 1024
+RESPONSE_CACHE_MAX_ENTRY    = 32 * 1024 * 1024  # larger replies are forwarded but not cached
+RESPONSE_CACHE_DISK_ENABLED = False             # keep cached replies in a SQLite file too so a restarted proxy starts warm
+RESPONSE_CACHE_DISK_PATH    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zephyr_proxy_cache.db")
+RESPONSE_CACHE_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+SINGLE_FLIGHT_ENABLED       = True              # identical GETs arriving while one is in flight share its reply
+POST_AGGREGATION_ENABLED    = True              # concurrent POSTs of JSON arrays to POST_AGGREGATION_URLS are merged into one
+POST_AGGREGATION_WINDOW     = 0.05              # seconds the first POST waits for others to join it
+POST_AGGREGATION_MAX_ITEMS  = 200               # array elements of one merged POST, a full merge is sent right away
+WRITE_BEHIND_ENABLED        = False             # acknowledge WRITE_BEHIND_URLS writes once journaled, zephyr gets them in the background
+WRITE_BEHIND_JOURNAL_PATH   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zephyr_proxy_journal.log")
+WRITE_BEHIND_RETRY_DELAY    = 1.0               # seconds before a journaled write zephyr did not accept is sent again, doubled per retry
+WRITE_BEHIND_MAX_RETRY_DELAY = 60.0
+IDEMPOTENCY_KEY_TTL         = 600               # seconds the reply of a write carrying an idempotency key is kept for its retries
+IDEMPOTENCY_MAX_KEYS        = 10000             # idempotency keys kept at once, the oldest are forgotten first
+IDEMPOTENCY_MAX_BYTES       = 32 * 1024 * 1024  # reply bytes kept for idempotency keys, the oldest are forgotten first
+IDEMPOTENCY_MAX_REPLY_BYTES = 256 * 1024        # larger replies are kept as status only, a retry gets an empty body
+
+#OPERATIONS (same templates as zephyr_reporting.py, upper case words are placeholders)
+LIST_ALL_PROJECTS                   = "/project/"
+LIST_ALL_RELEASES                   = "/release/project/PROJECTID"
+GET_CYCLE_PHASE                     = "/cycle/release/RELEASEID"
+CLONE_CYCLE                         = "/cycle/clone/CYCLEID?deep=DEEPFLAG&copyassignments=COPYASSIGN"
+CREATE_CYCLE                        = "/cycle/"
+CLONE_CYCLE_PHASE                   = "/cycle/cyclephase/clone/CYCLE_PHASE_ID"
+CREATE_PHASE                        = "/cycle/CYCLE_ID/phase"
+UPDATE_CYCLE_PHASE_VAL              = "/cycle/CYCLE_ID/phase"
+GET_ALL_EXECUTION_BY_CRITERIA       = "/execution?testerid=TESTER_ID&cyclephaseid=CYCLE_PHASE_ID&releaseid=RELEASE_ID&pagesize=PAGE_SIZE"
+GET_ALL_EXECUTION                   = "/execution?cyclephaseid=CYCLE_PHASE_ID&releaseid=RELEASE_ID&pagesize=PAGE_SIZE"
+UPDATE_EXECUTION_RESULT             = "/execution/EXECUTION_ID?status=EXECUTION_RESULT&testerid=TESTER_ID&allExecutions=false"
+UPDATE_TEST_STEP_RESULT             = "/execution/teststepresult/saveorupdate"
+GET_USER_DETAILS                    = "/user/current"
+GET_TEST_CASES_FOR_ASSIGN           = "/assignmenttree/testcase/CYCLE_PHASE_ID"
+CHANGE_ASSIGNMENTS                  = "/assignmenttree/CYCLE_PHASE_ID/bulk/tree/TCR_CATALOG_TREE_ID/from/10/to/TESTER_ID?easmode=1"
+GET_TEST_CASES_BY_TREEID            = "/testcase/tree/TREE_ID?pagesize=500"
+GET_ASSIGNMENT_TREEID               = "/assignmenttree/CYCLE_PHASE_ID"
+CREATE_PHASE_TEST_PLAN_BY_SEARCHID  = "/assignmenttree/CYCLE_PHASE_ID/assign/bysearch/ASSIGNMENT_TREE_ID?includehierarchy=true"
+CREATE_PHASE_TEST_PLAN_BY_TREEID    = "/assignmenttree/CYCLE_PHASE_ID/assign/bytree/ASSIGNMENT_TREE_ID?includehierarchy=true"
+FETCH_TEST_CASE_STEPS               = "/testcase/TEST_CASE_ZEPHYR_ID/teststep?isfetchstepversion=IS_FETCH_VERSION&versionId=TEST_CASE_VERION_ID"
+FETCH_ALL_TEST_CASE                 = "/testcasetree?type=Phase&releaseid=RELEASE_ID"
+
+#Seconds a cached GET reply stays fresh, GET urls matching none of these templates are never cached
+RESPONSE_CACHE_TTL_RULES    = [(LIST_ALL_PROJECTS,              300),
+                               (LIST_ALL_RELEASES,              300),
+                               (GET_CYCLE_PHASE,                60),
+                               (GET_USER_DETAILS,               600),
+                               (GET_ALL_EXECUTION_BY_CRITERIA,  30),
+                               (GET_ALL_EXECUTION,              30),
+                               (GET_TEST_CASES_FOR_ASSIGN,      60),
+                               (GET_ASSIGNMENT_TREEID,          60),
+                               (GET_TEST_CASES_BY_TREEID,       300),
+                               (FETCH_TEST_CASE_STEPS,          300),
+                               (FETCH_ALL_TEST_CASE,            300)]
+
+#POST/PUT url template -> cached GET templates evicted once the write is answered
+CYCLE_STATE_GETS            = [GET_CYCLE_PHASE]
+EXECUTION_STATE_GETS        = [GET_ALL_EXECUTION_BY_CRITERIA, GET_ALL_EXECUTION]
+ASSIGNMENT_STATE_GETS       = [GET_ASSIGNMENT_TREEID, GET_TEST_CASES_FOR_ASSIGN] + EXECUTION_STATE_GETS
+CACHE_INVALIDATION_RULES    = [(CREATE_CYCLE,                       CYCLE_STATE_GETS),
+                               (CLONE_CYCLE,                        CYCLE_STATE_GETS + ASSIGNMENT_STATE_GETS),
+                               (CLONE_CYCLE_PHASE,                  CYCLE_STATE_GETS + ASSIGNMENT_STATE_GETS),
+                               (UPDATE_CYCLE_PHASE_VAL,             CYCLE_STATE_GETS + ASSIGNMENT_STATE_GETS),
+                               (UPDATE_EXECUTION_RESULT,            EXECUTION_STATE_GETS),
+                               (UPDATE_TEST_STEP_RESULT,            EXECUTION_STATE_GETS),
+                               (CHANGE_ASSIGNMENTS,                 ASSIGNMENT_STATE_GETS),
+                               (CREATE_PHASE_TEST_PLAN_BY_SEARCHID, CYCLE_STATE_GETS + ASSIGNMENT_STATE_GETS),
+                               (CREATE_PHASE_TEST_PLAN_BY_TREEID,   CYCLE_STATE_GETS + ASSIGNMENT_STATE_GETS)]
+
+class CProxyMetrics:
+    '''
+    This class stores proxy counters and gauges shared by all threads
+    '''
+    def __init__(self):
+        '''
+        Initializing class member variables
+        '''
+        self.m_lock             = threading.Lock()
+        self.m_counters         = {}
+        self.m_gauges           = {}
+
+    def increment(self, name, value=1):
+
+        with self.m_lock:
+            self.m_counters[name] = self.m_counters.get(name, 0) + value
+
+    def setGauge(self, name, value):
+
+        with self.m_lock:
+            self.m_gauges[name] = value
+
+    def removeGauge(self, name):
+
+        with self.m_lock:
+            self.m_gauges.pop(name, None)
+
+    def get(self, name):
+
+        with self.m_lock:
+            return self.m_counters.get(name, self.m_gauges.get(name, 0))
+
+    def snapshot(self):
+        '''
+        Returns a copy of every counter and gauge
+        :return:
+        '''
+        with self.m_lock:
+            values = dict(self.m_counters)
+            values.update(self.m_gauges)
+            return values
+
+Proxy_Metrics               = CProxyMetrics()
+
+class CConnectionLifecycleManager:
+    '''
+    This class tracks live client connections and reaps them once the peer is gone
+    '''
+    def __init__(self):
+        '''
+        Initializing class member variables
+        '''
+        self.m_lock             = threading.Lock()
+        self.m_handlers         = {}
+
+    def register(self, handler):
+        '''
+        Track a newly accepted client connection and enable TCP keepalive to detect dead peers
+        :param handler: CConnectionHandler
+        :return:
+        '''
+        try:
+            handler.connectionSocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                handler.connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+                handler.connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+                handler.connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+        except socket.error as exp:
+            print ("Unable to enable keepalive for %s : %s" %(str(handler.connectionInfo), exp))
+        with self.m_lock:
+            self.m_handlers[id(handler)] = handler
+            Proxy_Metrics.setGauge("connections.active", len(self.m_handlers))
+        Proxy_Metrics.increment("connections.accepted")
+
+    def reap(self, handler, reason):
+        '''
+        Close the socket of a finished client connection and forget its handler
+        :param handler: CConnectionHandler
+        :param reason: eof, reset, exit, invalid, overloaded, error or shutdown
+        :return:
+        '''
+        with self.m_lock:
+            if self.m_handlers.pop(id(handler), None) is None:
+                return
+            Proxy_Metrics.setGauge("connections.active", len(self.m_handlers))
+        print ("Reaping TCP connection from %s : %s" %(str(handler.connectionInfo), reason))
+        handler.socketStatus = False
+        handler.close()
+        Proxy_Metrics.increment("connections.reaped")
+        Proxy_Metrics.increment("connections.reaped." + reason)
+
+    def reapAll(self, reason):
+
+        with self.m_lock:
+            handlers = self.m_handlers.values()
+        for handler in handlers:
+            self.reap(handler, reason)
+
+Connection_Manager          = CConnectionLifecycleManager()
+
+def getRequestLane(methodType, url, priority=None):
+    '''
+    Returns the queue lane of a request : the client supplied priority when valid, otherwise writes go to
+    the write lane and GETs of BULK_URL_PARTS families to the bulk lane
+    '''
+    if priority in REQUEST_LANES:
+        return priority
+    if methodType in ["POST", "PUT", "EXIT"]:
+        return "write"
+    if methodType == "GET" and url is not None and any(urlPart in url for urlPart in BULK_URL_PARTS):
+        return "bulk"
+    return "interactive"
+
 class CRequestData:
     '''
     This class stores request data
     '''
-    def __init__(self, pMethodType, pHttpURL, pDataPayload, connectionInfo, connectionSocket, socketStatus):
+    def __init__(self, pMethodType, pHttpURL, pDataPayload, connectionInfo, connectionSocket, socketStatus,
+                 responseSequencer=None, protocolVersion=1, requestId=0, replyHandler=None, priority=None, deadline=None,
+                 idempotencyKey=None):
         '''
         Initialize class member variables
         :param self:
         :param pMethodType:
         :param pHttpURL:
-        :param pDataPayload:
+        :param pDataPayload: base64 encoded body for protocol 1, raw body bytes for protocol 2
         :param pAddr:
+        :param responseSequencer: keeps replies of the client connection in request order
+        :param protocolVersion: framing used by the client connection
+        :param requestId: client chosen correlation id echoed in the reply, replies of non zero ids are sent as soon as they complete
+        :param replyHandler: called with (request, CProxyResponse or None) instead of replying to the client
+        :param priority: REQUEST_LANES entry chosen by the client, None to classify the request by method and url
+        :param deadline: epoch seconds after which the client no longer waits for the reply, None for no deadline
+        :param idempotencyKey: client chosen key of a POST/PUT, resending the write with the same key never applies it twice
         :return:
         '''
-        self.m_methodType       = pMethodType
-        self.m_httpURL          = pHttpURL
-        self.m_dataPayload      = pDataPayload
-        self.m_connectionInfo   = connectionInfo
-        self.m_connectionSocket = connectionSocket
-        self.socketStatus       = socketStatus
+        self.m_methodType           = pMethodType
+        self.m_httpURL              = pHttpURL
+        self.m_dataPayload          = pDataPayload
+        self.m_connectionInfo       = connectionInfo
+        self.m_connectionSocket     = connectionSocket
+        self.socketStatus           = socketStatus
+        self.m_responseSequencer    = responseSequencer
+        self.m_sequenceNumber       = None if responseSequencer is None or requestId != 0 else responseSequencer.nextSequenceNumber()
+        self.m_protocolVersion      = protocolVersion
+        self.m_requestId            = requestId
+        self.m_replyHandler         = replyHandler
+        self.m_priority             = priority
+        self.m_lane                 = getRequestLane(pMethodType, pHttpURL, priority)
+        self.m_admitted             = False         # counted in the in-flight requests of the connection until answered
+        self.m_deadline             = None if deadline is None else float(deadline)
+        self.m_isMergeable          = True          # POST may be merged by Post_Aggregator
+        self.m_idempotencyKey       = idempotencyKey
+        self.m_idempotencyEntry     = None          # Idempotency_Table entry this request fills with its reply
+        self.m_queuedAt             = time.time()
 
-class CHttpClass:
+    def isExpired(self):
+
+        return self.m_deadline is not None and time.time() >= self.m_deadline
+
+    def getRequestBody(self):
+        '''
+        Returns the body to forward to zephyr, None when the request has no body
+        :return:
+        '''
+        if self.m_dataPayload is None or len(self.m_dataPayload) == 0:
+            return None
+        if self.m_protocolVersion >= 2:
+            return self.m_dataPayload
+        return base64.b64decode(self.m_dataPayload)
+
+class CFairLane:
     '''
-    This class process http request get/post/put
+    This class is one CRequestQueue lane. Requests are kept in one FIFO per client connection and served by
+    deficit round robin : a client gets FAIR_QUEUE_QUANTUM per turn and pays one per request plus one per
+    started FAIR_QUEUE_COST_BYTES of payload, so a client pipelining thousands of requests only delays the
+    others by one turn
+    '''
+    def __init__(self, quantum, costBytes):
+        '''
+        Initializing class member variables
+        :param quantum: credit a client gets at the start of its turn
+        :param costBytes: payload bytes costing as much as one request
+        '''
+        self.m_quantum          = quantum
+        self.m_costBytes        = costBytes
+        self.m_clients          = collections.OrderedDict()   # connectionInfo -> deque of (enqueued at, CRequestData), head has the turn
+        self.m_deficits         = {}
+        self.m_turnStarted      = False
+        self.m_size             = 0
+
+    def __len__(self):
+
+        return self.m_size
+
+    def getCost(self, content):
+
+        payloadLength = len(content.m_dataPayload) if content.m_dataPayload else 0
+        return 1 + (payloadLength + self.m_costBytes - 1) // self.m_costBytes
+
+    def append(self, enqueuedAt, content):
+
+        clientRequests = self.m_clients.get(content.m_connectionInfo)
+        if clientRequests is None:
+            clientRequests = self.m_clients[content.m_connectionInfo] = collections.deque()
+            self.m_deficits[content.m_connectionInfo] = 0
+        clientRequests.append((enqueuedAt, content))
+        self.m_size += 1
+
+    def oldestEnqueuedAt(self):
+
+        return min(clientRequests[0][0] for clientRequests in self.m_clients.values())
+
+    def popleft(self):
+        '''
+        Returns the (enqueued at, CRequestData) to serve next, the lane must not be empty
+        '''
+        while True:
+            clientKey, clientRequests = next(iter(self.m_clients.items()))
+            if not self.m_turnStarted:
+                self.m_deficits[clientKey] += self.m_quantum
+                self.m_turnStarted = True
+            cost = self.getCost(clientRequests[0][1])
+            if self.m_deficits[clientKey] >= cost:
+                self.m_deficits[clientKey] -= cost
+                self.m_size -= 1
+                item = clientRequests.popleft()
+                if len(clientRequests) == 0:
+                    # an idle client does not bank credit for its next burst
+                    del self.m_clients[clientKey]
+                    del self.m_deficits[clientKey]
+                    self.m_turnStarted = False
+                return item
+            # turn over, the client keeps its remaining credit and queues behind the others
+            del self.m_clients[clientKey]
+            self.m_clients[clientKey] = clientRequests
+            self.m_turnStarted = False
+
+class CRequestQueue:
+    '''
+    This class queues client requests for the dispatcher workers in one CFairLane per REQUEST_LANES entry.
+    get serves the first non empty lane in priority order, but a lane left unserved for longer than its
+    REQUEST_LANE_MAX_WAIT gets the next turn, so bulk crawls are slowed down by writes without starving.
+    Queue.Queue interface : put, blocking get and qsize, None items stop the workers and skip the lanes
+    '''
+    def __init__(self, lanes, laneMaxWait, maxSize=REQUEST_QUEUE_MAX_SIZE, quantum=FAIR_QUEUE_QUANTUM, costBytes=FAIR_QUEUE_COST_BYTES):
+        '''
+        Initializing class member variables
+        :param lanes: lane names in priority order
+        :param laneMaxWait: lane name -> seconds it may go unserved while it has requests
+        :param maxSize: queued requests above which tryPut refuses client requests
+        :param quantum: CFairLane credit per client turn
+        :param costBytes: CFairLane payload bytes per request cost
+        '''
+        self.m_condition        = threading.Condition()
+        self.m_maxSize          = maxSize
+        self.m_lanes            = collections.OrderedDict((lane, CFairLane(quantum, costBytes)) for lane in lanes)
+        self.m_laneMaxWait      = laneMaxWait
+        self.m_laneServedAt     = dict((lane, 0.0) for lane in lanes)
+        self.m_clientDepths     = {}
+        self.m_stopItems        = collections.deque()
+        self.m_size             = 0
+
+    def tryPut(self, content):
+        '''
+        Queue a new client request unless REQUEST_QUEUE_MAX_SIZE requests are already waiting
+        :param content: CRequestData
+        :return: False when the queue is full
+        '''
+        with self.m_condition:
+            if self.m_size >= self.m_maxSize:
+                return False
+            self.put(content)
+            return True
+
+    def put(self, content):
+        '''
+        Queue content regardless of the size limit, used for work already accepted : BATCH items, EXIT and worker stops
+        '''
+        with self.m_condition:
+            if content is None:
+                self.m_stopItems.append(content)
+            else:
+                lane = self.m_lanes[content.m_lane]
+                lane.append(time.time(), content)
+                self.m_size += 1
+                Proxy_Metrics.setGauge("queue.depth.%s" %content.m_lane, len(lane))
+                self.updateClientDepth(content.m_connectionInfo, 1)
+            self.m_condition.notify()
+
+    def updateClientDepth(self, connectionInfo, change):
+        '''
+        Maintain the queue.client_depth gauge of a client connection, caller holds self.m_condition
+        '''
+        depth = self.m_clientDepths.get(connectionInfo, 0) + change
+        gaugeName = "queue.client_depth.%s" %("%s:%s" %connectionInfo if connectionInfo else "unknown")
+        if depth > 0:
+            self.m_clientDepths[connectionInfo] = depth
+            Proxy_Metrics.setGauge(gaugeName, depth)
+        else:
+            # gauges of drained clients are dropped so closed connections do not pile up in the metrics
+            self.m_clientDepths.pop(connectionInfo, None)
+            Proxy_Metrics.removeGauge(gaugeName)
+
+    def get(self):
+        '''
+        Block until a request is queued
+        :return: CRequestData or None
+        '''
+        with self.m_condition:
+            while len(self.m_stopItems) == 0 and self.m_size == 0:
+                self.m_condition.wait()
+            if len(self.m_stopItems) > 0:
+                return self.m_stopItems.popleft()
+            laneName = self.selectLane()
+            lane = self.m_lanes[laneName]
+            enqueuedAt, content = lane.popleft()
+            self.m_size -= 1
+            currentTime = time.time()
+            self.m_laneServedAt[laneName] = currentTime
+            Proxy_Metrics.setGauge("queue.depth.%s" %laneName, len(lane))
+            self.updateClientDepth(content.m_connectionInfo, -1)
+        Proxy_Metrics.increment("queue.served.%s" %laneName)
+        Proxy_Metrics.increment("queue.wait_seconds.%s" %laneName, currentTime - enqueuedAt)
+        return content
+
+    def selectLane(self):
+        '''
+        Returns the lane to serve next, caller holds self.m_condition and at least one lane has requests
+        '''
+        currentTime = time.time()
+        firstLaneName = None
+        for laneName, lane in self.m_lanes.items():
+            if len(lane) == 0:
+                continue
+            if firstLaneName is None:
+                firstLaneName = laneName
+                continue
+            # a lane is starving when neither its head request nor the lane was served within its max wait
+            maxWait = self.m_laneMaxWait.get(laneName)
+            if maxWait is not None and currentTime - max(lane.oldestEnqueuedAt(), self.m_laneServedAt[laneName]) > maxWait:
+                Proxy_Metrics.increment("queue.starvation_promotions.%s" %laneName)
+                return laneName
+        return firstLaneName
+
+    def qsize(self):
+
+        with self.m_condition:
+            return self.m_size
+
+Queue_Container             = CRequestQueue(REQUEST_LANES, REQUEST_LANE_MAX_WAIT, REQUEST_QUEUE_MAX_SIZE)
+Busy_Reply_Queue            = Queue.Queue(BUSY_REPLY_QUEUE_MAX_SIZE)
+
+class CProxyResponse:
+    '''
+    This class stores a zephyr reply as raw bytes so the proxy never parses JSON bodies it only forwards
+    '''
+    def __init__(self, statusCode, contentType, body, etag=None, lastModified=None):
+        '''
+        Initializing class member variables
+        :param statusCode: http status code
+        :param contentType: Content-Type header of the zephyr reply
+        :param body: reply bytes as received from zephyr
+        :param etag: ETag header of the zephyr reply
+        :param lastModified: Last-Modified header of the zephyr reply
+        '''
+        self.m_statusCode       = statusCode
+        self.m_contentType      = contentType
+        self.m_body             = body
+        self.m_etag             = etag
+        self.m_lastModified     = lastModified
+        self.m_error            = None
+        self.m_retryAfter       = None
+        self.m_isUnsent         = False
+
+    @staticmethod
+    def error(statusCode, message, isUnsent=False):
+        '''
+        Returns a reply generated by the proxy for a request zephyr did not answer
+        :param isUnsent: the request never reached zephyr, a retry of it is not a duplicate
+        '''
+        proxyResponse = CProxyResponse(statusCode, CONTENT_TYPE, json.dumps({"error": message}))
+        proxyResponse.m_error = message
+        proxyResponse.m_isUnsent = isUnsent
+        return proxyResponse
+
+    @staticmethod
+    def busy(message, retryAfter):
+        '''
+        Returns the reply of a request the proxy refused to queue, the client may resend it after retryAfter seconds
+        '''
+        proxyResponse = CProxyResponse(503, CONTENT_TYPE, json.dumps({"error": message, "retryAfter": retryAfter}))
+        proxyResponse.m_error = message
+        proxyResponse.m_retryAfter = retryAfter
+        return proxyResponse
+
+    @staticmethod
+    def fromHttpResponse(response):
+
+        return CProxyResponse(response.status_code, response.headers.get("Content-Type"), response.content,
+                              response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+    def isJSON(self):
+
+        return len(self.m_body) > 0 and self.m_contentType is not None and "json" in self.m_contentType.lower()
+
+    def hasValidators(self):
+
+        return self.m_etag is not None or self.m_lastModified is not None
+
+    def revalidated(self, response):
+        '''
+        Returns this reply refreshed by a 304 Not Modified response, zephyr may send updated validators with it
+        :param response: 304 http response
+        :return:
+        '''
+        return CProxyResponse(200, self.m_contentType, self.m_body,
+                              response.headers.get("ETag", self.m_etag), response.headers.get("Last-Modified", self.m_lastModified))
+
+def sendAll(connectionSocket, msg):
+    '''
+    Send a wire message given as one string or as a list of chunks, avoiding a copy of large bodies
+    :param connectionSocket:
+    :param msg:
+    :return:
+    '''
+    if isinstance(msg, list):
+        if sum(len(chunk) for chunk in msg) > SOCKET_RECV_SIZE:
+            for chunk in msg:
+                connectionSocket.sendall(chunk)
+            return
+        # Small replies go out in one segment, a separate header write would wait on delayed ACK
+        msg = "".join(msg)
+    connectionSocket.sendall(msg)
+
+def compileURLTemplate(template):
+    '''
+    Returns a regular expression matching request urls built from an operation template
+    :param template: e.g. /cycle/release/RELEASEID, upper case words are placeholders
+    :return:
+    '''
+    literalParts = re.split(r"[A-Z][A-Z_]*[A-Z]", template)
+    return re.compile("(?:" + "[^/?&]+".join(re.escape(part) for part in literalParts) + ")$")
+
+class CCacheEntry:
+    '''
+    This class stores one cached zephyr reply
+    '''
+    def __init__(self, url, proxyResponse, template, ttl, fetchedAt=None):
+
+        self.m_url              = url
+        self.m_proxyResponse    = proxyResponse
+        self.m_template         = template
+        self.m_fetchedAt        = time.time() if fetchedAt is None else fetchedAt
+        self.m_expiresAt        = self.m_fetchedAt + ttl
+        self.m_size             = len(proxyResponse.m_body) + len(url)
+
+    def isFresh(self):
+
+        return time.time() < self.m_expiresAt
+
+class CDiskResponseCache:
+    '''
+    This class keeps cached replies in a SQLite file below the in-memory cache.
+    The file is opened on first use and rows are only read back when the in-memory cache misses,
+    so a restarted proxy serves warm replies without loading the whole file at startup.
+    Least recently used rows are deleted once the stored bytes exceed maxBytes
+    '''
+    def __init__(self, path, maxBytes):
+        '''
+        Initializing class member variables
+        :param path: SQLite file
+        :param maxBytes:
+        '''
+        self.m_lock             = threading.Lock()
+        self.m_path             = path
+        self.m_maxBytes         = maxBytes
+        self.m_connection       = None
+        self.m_bytes            = 0
+
+    def getConnection(self):
+        '''
+        Open the SQLite file on first use, caller holds self.m_lock
+        '''
+        if self.m_connection is None:
+            connection = sqlite3.connect(self.m_path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS responses (credential TEXT, url TEXT, template TEXT, statusCode INTEGER, "
+                               "contentType TEXT, body BLOB, etag TEXT, lastModified TEXT, fetchedAt REAL, lastUsed REAL, "
+                               "size INTEGER, PRIMARY KEY (credential, url))")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_lastUsed ON responses (lastUsed)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_template ON responses (template)")
+            self.m_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            self.m_connection = connection
+            print ("Response cache file %s opened with %d bytes" %(self.m_path, self.m_bytes))
+        return self.m_connection
+
+    @staticmethod
+    def getCredential(authorization):
+        '''
+        Credentials are stored hashed, the cache file must not leak zephyr passwords
+        '''
+        return hashlib.sha1(authorization or "").hexdigest()
+
+    def get(self, key):
+        '''
+        Returns (CProxyResponse, template, fetched-at time) stored for key, None when absent
+        :param key: (authorization, url)
+        :return:
+        '''
+        try:
+            credential = self.getCredential(key[0])
+            with self.m_lock:
+                connection = self.getConnection()
+                row = connection.execute("SELECT template, statusCode, contentType, body, etag, lastModified, fetchedAt FROM responses "
+                                         "WHERE credential = ? AND url = ?", (credential, key[1])).fetchone()
+                if row is None:
+                    return None
+                connection.execute("UPDATE responses SET lastUsed = ? WHERE credential = ? AND url = ?", (time.time(), credential, key[1]))
+                connection.commit()
+            template, statusCode, contentType, body, etag, lastModified, fetchedAt = row
+            return CProxyResponse(statusCode, contentType, str(body), etag, lastModified), template, fetchedAt
+        except Exception as exp:
+            print ("Exception in CDiskResponseCache::get : %s" %exp)
+            return None
+
+    def put(self, key, entry, isCurrent):
+        '''
+        Store a cache entry, replacing the row of the same key
+        :param key: (authorization, url)
+        :param entry: CCacheEntry
+        :param isCurrent: called under self.m_lock, False when an invalidation made entry stale meanwhile
+        :return:
+        '''
+        try:
+            proxyResponse = entry.m_proxyResponse
+            credential = self.getCredential(key[0])
+            with self.m_lock:
+                if not isCurrent():
+                    return
+                connection = self.getConnection()
+                self.deleteRows(connection, "credential = ? AND url = ?", (credential, key[1]))
+                connection.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (credential, key[1], entry.m_template, proxyResponse.m_statusCode, proxyResponse.m_contentType,
+                                    buffer(proxyResponse.m_body), proxyResponse.m_etag, proxyResponse.m_lastModified,
+                                    entry.m_fetchedAt, time.time(), entry.m_size))
+                self.m_bytes += entry.m_size
+                while self.m_bytes > self.m_maxBytes:
+                    row = connection.execute("SELECT credential, url FROM responses ORDER BY lastUsed LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    self.deleteRows(connection, "credential = ? AND url = ?", row)
+                    Proxy_Metrics.increment("cache.disk_evictions")
+                connection.commit()
+                Proxy_Metrics.setGauge("cache.disk_bytes", self.m_bytes)
+        except Exception as exp:
+            print ("Exception in CDiskResponseCache::put : %s" %exp)
+
+    def refresh(self, key, entry, isCurrent):
+        '''
+        Update fetched-at time and validators of a row revalidated by a 304, its body is unchanged
+        :param key: (authorization, url)
+        :param entry: CCacheEntry
+        :param isCurrent: called under self.m_lock, False when an invalidation made entry stale meanwhile
+        :return:
+        '''
+        try:
+            proxyResponse = entry.m_proxyResponse
+            with self.m_lock:
+                if not isCurrent():
+                    return
+                connection = self.getConnection()
+                cursor = connection.execute("UPDATE responses SET etag = ?, lastModified = ?, fetchedAt = ?, lastUsed = ? WHERE credential = ? AND url = ?",
+                                            (proxyResponse.m_etag, proxyResponse.m_lastModified, entry.m_fetchedAt, time.time(),
+                                             self.getCredential(key[0]), key[1]))
+                connection.commit()
+            if cursor.rowcount == 0:
+                # the row was evicted meanwhile, store it again
+                self.put(key, entry, isCurrent)
+        except Exception as exp:
+            print ("Exception in CDiskResponseCache::refresh : %s" %exp)
+
+    def invalidate(self, templates):
+        '''
+        Delete every row cached for the given GET templates
+        '''
+        try:
+            with self.m_lock:
+                connection = self.getConnection()
+                for template in templates:
+                    self.deleteRows(connection, "template = ?", (template,))
+                connection.commit()
+                Proxy_Metrics.setGauge("cache.disk_bytes", self.m_bytes)
+        except Exception as exp:
+            print ("Exception in CDiskResponseCache::invalidate : %s" %exp)
+
+    def deleteRows(self, connection, condition, args):
+        '''
+        Delete rows matching condition keeping the stored byte count, caller holds self.m_lock
+        '''
+        self.m_bytes -= connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses WHERE " + condition, args).fetchone()[0]
+        connection.execute("DELETE FROM responses WHERE " + condition, args)
+
+class CResponseCache:
+    '''
+    This class is a bounded in-memory cache of GET replies keyed by url and credentials.
+    Entries expire after the TTL of the first RESPONSE_CACHE_TTL_RULES template matching the url and
+    the least recently used entries are evicted once the cached bytes exceed maxBytes.
+    Answered writes evict every entry of the GET templates CACHE_INVALIDATION_RULES maps them to.
+    With a diskCache every entry is written through to it and memory misses are looked up there
+    '''
+    def __init__(self, maxBytes, ttlRules, invalidationRules, diskCache=None):
+        '''
+        Initializing class member variables
+        :param maxBytes:
+        :param ttlRules: list of (url template, ttl in seconds)
+        :param invalidationRules: list of (write url template, list of GET url templates)
+        :param diskCache: CDiskResponseCache or None
+        '''
+        self.m_diskCache        = diskCache
+        self.m_lock             = threading.Lock()
+        self.m_entries          = collections.OrderedDict()
+        self.m_templateKeys     = collections.defaultdict(set)
+        self.m_maxBytes         = maxBytes
+        self.m_bytes            = 0
+        self.m_generations      = {}
+        self.m_ttlRules         = [(compileURLTemplate(template), template, ttl) for template, ttl in ttlRules]
+        self.m_invalidationRules = [(compileURLTemplate(template), getTemplates) for template, getTemplates in invalidationRules]
+
+    def getRule(self, url):
+        '''
+        Returns (template, ttl) of url, None when url is not cacheable
+        '''
+        path = url.split("://", 1)[-1]
+        for pattern, template, ttl in self.m_ttlRules:
+            if pattern.search(path):
+                return template, ttl
+        return None
+
+    def getGeneration(self, url):
+        '''
+        Returns the counter of the GET template of url, bumped by every invalidation of that template.
+        A reply fetched across an invalidation of its own template is not cached
+        '''
+        template = self.getTemplate(url)
+        with self.m_lock:
+            return self.m_generations.get(template, 0)
+
+    def get(self, key):
+        '''
+        Returns the fresh CProxyResponse cached for key, None on a miss
+        :param key: (authorization, url)
+        :return:
+        '''
+        rule = self.getRule(key[1])
+        if rule is None:
+            return None
+        with self.m_lock:
+            entry = self.m_entries.get(key)
+            if entry is not None and not entry.isFresh():
+                # expired entries with validators stay for getStale to revalidate
+                if not entry.m_proxyResponse.hasValidators():
+                    self.removeEntry(key)
+                entry = None
+            elif entry is not None:
+                # move to the most recently used end
+                del self.m_entries[key]
+                self.m_entries[key] = entry
+            generation = self.m_generations.get(rule[0], 0)
+        if entry is None and self.m_diskCache is not None and key not in self.m_entries:
+            entry = self.loadEntry(key, rule, generation)
+        if entry is None:
+            Proxy_Metrics.increment("cache.misses")
+            return None
+        Proxy_Metrics.increment("cache.hits")
+        return entry.m_proxyResponse
+
+    def loadEntry(self, key, rule, generation):
+        '''
+        Look up a memory miss in the disk cache, rows kept in memory are fresh or can be revalidated
+        :param key: (authorization, url)
+        :param rule: (template, ttl) of the url
+        :param generation: getGeneration() value of the url read before the lookup
+        :return: fresh CCacheEntry or None
+        '''
+        stored = self.m_diskCache.get(key)
+        if stored is None:
+            return None
+        proxyResponse, template, fetchedAt = stored
+        entry = CCacheEntry(key[1], proxyResponse, rule[0], rule[1], fetchedAt)
+        if template != rule[0] or not (entry.isFresh() or proxyResponse.hasValidators()):
+            return None
+        with self.m_lock:
+            if generation != self.m_generations.get(rule[0], 0):
+                return None
+            self.storeEntry(key, entry)
+        if not entry.isFresh():
+            return None
+        Proxy_Metrics.increment("cache.disk_hits")
+        return entry
+
+    def getStale(self, key):
+        '''
+        Returns the expired CProxyResponse kept for key when it carries an ETag or Last-Modified validator
+        :param key: (authorization, url)
+        :return:
+        '''
+        with self.m_lock:
+            entry = self.m_entries.get(key)
+            if entry is None or entry.isFresh() or not entry.m_proxyResponse.hasValidators():
+                return None
+            return entry.m_proxyResponse
+
+    def put(self, key, proxyResponse, generation, revalidated=False):
+        '''
+        Cache a successful reply when its url is cacheable
+        :param key: (authorization, url)
+        :param proxyResponse:
+        :param generation: getGeneration() value of the url read before the reply was requested
+        :param revalidated: proxyResponse is a stale entry confirmed by a 304, the disk copy of its body is kept
+        :return:
+        '''
+        rule = self.getRule(key[1])
+        if rule is None or proxyResponse.m_statusCode != 200 or len(proxyResponse.m_body) > RESPONSE_CACHE_MAX_ENTRY:
+            return
+        entry = CCacheEntry(key[1], proxyResponse, rule[0], rule[1])
+        with self.m_lock:
+            if generation != self.m_generations.get(rule[0], 0):
+                # a write of this template's family was answered while this reply was in flight, it may be stale already
+                Proxy_Metrics.increment("cache.stale_puts_skipped")
+                return
+            self.storeEntry(key, entry)
+        if self.m_diskCache is not None:
+            isCurrent = lambda: generation == self.m_generations.get(rule[0], 0)
+            if revalidated:
+                self.m_diskCache.refresh(key, entry, isCurrent)
+            else:
+                self.m_diskCache.put(key, entry, isCurrent)
+
+    def getTemplate(self, url):
+
+        rule = self.getRule(url)
+        return rule[0] if rule is not None else None
+
+    def invalidate(self, writeURL):
+        '''
+        Evict the cached GET families affected by an answered POST/PUT
+        :param writeURL:
+        :return: number of evicted entries
+        '''
+        path = writeURL.split("://", 1)[-1]
+        templates = set()
+        for pattern, getTemplates in self.m_invalidationRules:
+            if pattern.search(path):
+                templates.update(getTemplates)
+        if len(templates) == 0:
+            return 0
+        evictedCount = 0
+        with self.m_lock:
+            for template in templates:
+                self.m_generations[template] = self.m_generations.get(template, 0) + 1
+                for key in list(self.m_templateKeys.get(template, ())):
+                    self.removeEntry(key)
+                    evictedCount += 1
+            Proxy_Metrics.setGauge("cache.bytes", self.m_bytes)
+            Proxy_Metrics.setGauge("cache.entries", len(self.m_entries))
+        if self.m_diskCache is not None:
+            self.m_diskCache.invalidate(templates)
+        Proxy_Metrics.increment("cache.invalidations")
+        Proxy_Metrics.increment("cache.invalidated_entries", evictedCount)
+        return evictedCount
+
+    def storeEntry(self, key, entry):
+        '''
+        Insert one entry evicting least recently used ones, caller holds self.m_lock
+        '''
+        if key in self.m_entries:
+            self.removeEntry(key)
+        self.m_entries[key] = entry
+        self.m_templateKeys[entry.m_template].add(key)
+        self.m_bytes += entry.m_size
+        while self.m_bytes > self.m_maxBytes and len(self.m_entries) > 0:
+            self.removeEntry(next(iter(self.m_entries)))
+            Proxy_Metrics.increment("cache.evictions")
+        Proxy_Metrics.setGauge("cache.bytes", self.m_bytes)
+        Proxy_Metrics.setGauge("cache.entries", len(self.m_entries))
+
+    def removeEntry(self, key):
+        '''
+        Drop one entry, caller holds self.m_lock
+        '''
+        entry = self.m_entries.pop(key)
+        self.m_bytes -= entry.m_size
+        templateKeys = self.m_templateKeys[entry.m_template]
+        templateKeys.discard(key)
+        if len(templateKeys) == 0:
+            del self.m_templateKeys[entry.m_template]
+
+Response_Cache              = CResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_RULES, CACHE_INVALIDATION_RULES,
+                                             CDiskResponseCache(RESPONSE_CACHE_DISK_PATH, RESPONSE_CACHE_DISK_MAX_BYTES) if RESPONSE_CACHE_DISK_ENABLED else None)
+
+class CSingleFlight:
+    '''
+    This class coalesces identical in-flight GET requests : the first request (leader) goes to zephyr,
+    later identical requests attach to it and are answered with the leader's reply bytes
     '''
     def __init__(self):
         '''
-        Initializing class member variables in constructor
+        Initializing class member variables
         '''
-        self._httpSession                   = None
-        self._userName                      = USERNAME
-        self._password                      = PASSWORD
-        self._contentType                   = CONTENT_TYPE
-        self._encoded_login                 = base64.b64encode(b"%s:%s" %(self._userName, self._password))
-        self._authorization                 = "Basic %s" %(self._encoded_login)
+        self.m_lock             = threading.Lock()
+        self.m_inFlight         = {}
+
+    def join(self, key, content):
+        '''
+        Attach content to the in-flight call for key or make it the leader
+        :param key: (authorization, url)
+        :param content: CRequestData
+        :return: True when the caller is the leader and must fetch the reply
+        '''
+        with self.m_lock:
+            waiters = self.m_inFlight.get(key)
+            if waiters is None:
+                self.m_inFlight[key] = []
+                Proxy_Metrics.increment("singleflight.leaders")
+                return True
+            waiters.append(content)
+        Proxy_Metrics.increment("singleflight.saved")
+        return False
+
+    def complete(self, key):
+        '''
+        Close the in-flight call for key
+        :param key:
+        :return: requests which attached to the call
+        '''
+        with self.m_lock:
+            return self.m_inFlight.pop(key, [])
+
+Single_Flight               = CSingleFlight()
+
+POST_AGGREGATION_URLS       = [UPDATE_TEST_STEP_RESULT]  # zephyr answers these POSTs with one array element per posted element
+
+class CPostAggregator:
+    '''
+    This class merges concurrent POSTs of JSON arrays to the same url : the first POST (leader) holds its worker for
+    POST_AGGREGATION_WINDOW, POSTs arriving meanwhile append their arrays to it and free their workers, then the
+    leader sends one merged POST and answers every caller with its slice of the reply array
+    '''
+    def __init__(self, window, maxItems):
+        '''
+        Initializing class member variables
+        :param window: seconds a merge stays open
+        :param maxItems: array elements after which a merge is closed early
+        '''
+        self.m_condition        = threading.Condition()
+        self.m_window           = window
+        self.m_maxItems         = maxItems
+        self.m_openMerges       = {}                # (authorization, url) -> {"callers": [(CRequestData, items)], "itemCount": n}
+
+    def join(self, key, content, items):
+        '''
+        Add the array of a POST to the open merge for key or open one and wait for it to close
+        :param key: (authorization, url)
+        :param content: CRequestData
+        :param items: JSON array posted by the client
+        :return: list of (CRequestData, items) to send when the caller is the leader, None when the leader answers it
+        '''
+        with self.m_condition:
+            merge = self.m_openMerges.get(key)
+            if merge is not None and merge["itemCount"] + len(items) <= self.m_maxItems:
+                merge["callers"].append((content, items))
+                merge["itemCount"] += len(items)
+                if merge["itemCount"] >= self.m_maxItems:
+                    del self.m_openMerges[key]
+                    self.m_condition.notify_all()
+                Proxy_Metrics.increment("aggregation.merged")
+                return None
+            merge = {"callers": [(content, items)], "itemCount": len(items)}
+            self.m_openMerges[key] = merge
+            closeAt = time.time() + self.m_window
+            while self.m_openMerges.get(key) is merge and time.time() < closeAt:
+                self.m_condition.wait(closeAt - time.time())
+            if self.m_openMerges.get(key) is merge:
+                del self.m_openMerges[key]
+            return merge["callers"]
+
+Post_Aggregator             = CPostAggregator(POST_AGGREGATION_WINDOW, POST_AGGREGATION_MAX_ITEMS)
+
+WRITE_BEHIND_URLS           = [UPDATE_EXECUTION_RESULT]  # writes whose reply body clients do not use
+
+class CWriteBehindJournal:
+    '''
+    This class keeps writes acknowledged before zephyr has seen them in an append-only file, one JSON line per write,
+    fsync'd before the client gets its reply. CWriteBehindFlusherThread applies them to zephyr in journal order and
+    appends an "applied" line for each. Writes without such a line are applied again after a restart, the file is
+    emptied whenever every write is applied
+    '''
+    def __init__(self, path):
+        '''
+        Initializing class member variables
+        :param path: journal file
+        '''
+        self.m_condition        = threading.Condition()
+        self.m_path             = path
+        self.m_file             = None
+        self.m_pending          = collections.deque()   # journal entries not applied yet, oldest first
+        self.m_sequence         = 0
+        self.m_urlPatterns      = [compileURLTemplate(template) for template in WRITE_BEHIND_URLS]
+
+    def isJournaled(self, methodType, url):
+
+        return methodType in ["POST", "PUT"] and any(pattern.search(url) for pattern in self.m_urlPatterns)
+
+    def recover(self):
+        '''
+        Open the journal and queue the writes a previous run acknowledged but did not apply, the file is rewritten
+        with only those so it does not grow across restarts
+        :return: number of recovered writes
+        '''
+        with self.m_condition:
+            entries = collections.OrderedDict()
+            if os.path.isfile(self.m_path):
+                fp = open(self.m_path, "r")
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a crash may leave the last line incomplete, its write was never acknowledged
+                        continue
+                    if "applied" in record:
+                        entries.pop(record["applied"], None)
+                    else:
+                        entries[record["sequence"]] = record
+                        self.m_sequence = max(self.m_sequence, record["sequence"])
+                fp.close()
+            tmpPath = self.m_path + ".tmp"
+            fp = open(tmpPath, "w")
+            for record in entries.values():
+                fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.close()
+            os.rename(tmpPath, self.m_path)
+            self.m_file = open(self.m_path, "a")
+            self.m_pending.extend(entries.values())
+            Proxy_Metrics.setGauge("writebehind.pending", len(self.m_pending))
+            if len(entries) > 0:
+                print ("Replaying %s journaled writes from %s" %(len(entries), self.m_path))
+                self.m_condition.notify()
+            return len(entries)
+
+    def append(self, methodType, url, body):
+        '''
+        Journal a write, it is durable once this returns
+        :param methodType:
+        :param url:
+        :param body: raw request body or None
+        :return: journal sequence number of the write
+        '''
+        with self.m_condition:
+            self.m_sequence += 1
+            record = {"sequence": self.m_sequence, "method": methodType, "url": url,
+                      "body": None if body is None else base64.b64encode(body)}
+            self.m_file.write(json.dumps(record) + "\n")
+            self.m_file.flush()
+            os.fsync(self.m_file.fileno())
+            self.m_pending.append(record)
+            Proxy_Metrics.setGauge("writebehind.pending", len(self.m_pending))
+            self.m_condition.notify()
+        Proxy_Metrics.increment("writebehind.journaled")
+        return record["sequence"]
+
+    def peek(self, timeout):
+        '''
+        Returns the oldest write not applied yet, it stays pending until markApplied
+        :param timeout: seconds to wait for a write
+        :return: journal record or None
+        '''
+        with self.m_condition:
+            if len(self.m_pending) == 0:
+                self.m_condition.wait(timeout)
+            return self.m_pending[0] if len(self.m_pending) > 0 else None
+
+    def markApplied(self, record):
+
+        with self.m_condition:
+            self.m_pending.popleft()
+            if len(self.m_pending) == 0:
+                # every journaled write reached zephyr, start the file over
+                self.m_file.seek(0)
+                self.m_file.truncate()
+                self.m_file.flush()
+                os.fsync(self.m_file.fileno())
+            else:
+                self.m_file.write(json.dumps({"applied": record["sequence"]}) + "\n")
+                self.m_file.flush()
+            Proxy_Metrics.setGauge("writebehind.pending", len(self.m_pending))
+
+Write_Behind_Journal        = CWriteBehindJournal(WRITE_BEHIND_JOURNAL_PATH)
+
+class CIdempotencyTable:
+    '''
+    This class remembers the replies of writes carrying an idempotency key. A write whose key is known is not sent
+    to zephyr again : it gets the stored reply, or the reply of the original once that one completes. Replies are
+    kept IDEMPOTENCY_KEY_TTL seconds, at most IDEMPOTENCY_MAX_KEYS of them holding at most IDEMPOTENCY_MAX_BYTES,
+    the body of a reply above IDEMPOTENCY_MAX_REPLY_BYTES is not kept
+    '''
+    def __init__(self, ttl, maxKeys, maxBytes, maxReplyBytes):
+        '''
+        Initializing class member variables
+        :param ttl: seconds a reply is kept after the write completed
+        :param maxKeys:
+        :param maxBytes: body bytes of all kept replies
+        :param maxReplyBytes: body bytes of one kept reply
+        '''
+        self.m_lock             = threading.Lock()
+        self.m_ttl              = ttl
+        self.m_maxKeys          = maxKeys
+        self.m_maxBytes         = maxBytes
+        self.m_maxReplyBytes    = maxReplyBytes
+        self.m_bytes            = 0
+        self.m_entries          = collections.OrderedDict()  # (method, url, key) -> {"response", "waiters", "expiresAt"}, oldest first
+
+    def begin(self, content):
+        '''
+        Register a write carrying an idempotency key
+        :param content: CRequestData
+        :return: True when the caller must process the write, False when it is answered from the table
+        '''
+        if content.m_idempotencyEntry is not None:
+            # queued again after its first attempt, the write already owns its entry
+            return True
+        key = (content.m_methodType, content.m_httpURL, content.m_idempotencyKey)
+        currentTime = time.time()
+        with self.m_lock:
+            self.evictEntries(currentTime, self.m_maxKeys - 1)
+            entry = self.m_entries.get(key)
+            if entry is None:
+                entry = {"response": None, "waiters": [], "expiresAt": currentTime + self.m_ttl}
+                self.m_entries[key] = entry
+                content.m_idempotencyEntry = entry
+                Proxy_Metrics.setGauge("idempotency.keys", len(self.m_entries))
+                return True
+            proxyResponse = entry["response"]
+            if proxyResponse is None:
+                entry["waiters"].append(content)
+        if proxyResponse is None:
+            print ("Write %s attached to its in-flight original : %s" %(content.m_idempotencyKey, content.m_httpURL))
+            Proxy_Metrics.increment("idempotency.attached")
+        else:
+            print ("Write %s answered from the idempotency table : %s" %(content.m_idempotencyKey, content.m_httpURL))
+            Proxy_Metrics.increment("idempotency.replayed")
+            CProcessZephyrRequestThread.sendResponse(content, proxyResponse)
+        return False
+
+    def complete(self, content, proxyResponse):
+        '''
+        Store the reply of a write registered by begin and answer the retries which arrived meanwhile
+        :param content: CRequestData which got True from begin
+        :param proxyResponse: CProxyResponse
+        :return:
+        '''
+        entry = content.m_idempotencyEntry
+        content.m_idempotencyEntry = None
+        key = (content.m_methodType, content.m_httpURL, content.m_idempotencyKey)
+        storedResponse = proxyResponse
+        if len(proxyResponse.m_body) > self.m_maxReplyBytes:
+            storedResponse = CProxyResponse(proxyResponse.m_statusCode, proxyResponse.m_contentType, "")
+        with self.m_lock:
+            waiters = entry["waiters"]
+            entry["waiters"] = []
+            isCurrent = self.m_entries.get(key) is entry
+            if isCurrent:
+                del self.m_entries[key]
+            if not proxyResponse.m_isUnsent:
+                # zephyr saw the write, its retries get the stored reply. An unsent write is forgotten so a retry can send it
+                entry["response"] = storedResponse
+                entry["expiresAt"] = time.time() + self.m_ttl
+                if isCurrent:
+                    # moved to the newest end, the entries stay ordered by expiry
+                    self.m_entries[key] = entry
+                    self.m_bytes += len(storedResponse.m_body)
+            self.evictEntries(time.time(), self.m_maxKeys)
+        for waiter in waiters:
+            CProcessZephyrRequestThread.sendResponse(waiter, proxyResponse)
+
+    def evictEntries(self, currentTime, maxKeys):
+        '''
+        Forget expired entries and the oldest ones above maxKeys or IDEMPOTENCY_MAX_BYTES, caller holds self.m_lock
+        '''
+        while len(self.m_entries) > 0:
+            oldestKey, oldestEntry = next(iter(self.m_entries.items()))
+            if len(self.m_entries) <= maxKeys and self.m_bytes <= self.m_maxBytes and oldestEntry["expiresAt"] > currentTime:
+                break
+            # an in-flight write dropped here still answers its waiters through content.m_idempotencyEntry
+            del self.m_entries[oldestKey]
+            if oldestEntry["response"] is not None:
+                self.m_bytes -= len(oldestEntry["response"].m_body)
+        Proxy_Metrics.setGauge("idempotency.keys", len(self.m_entries))
+        Proxy_Metrics.setGauge("idempotency.bytes", self.m_bytes)
+
+Idempotency_Table           = CIdempotencyTable(IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_MAX_BYTES, IDEMPOTENCY_MAX_REPLY_BYTES)
+
+class CResponseSequencer:
+    '''
+    This class sends replies of one client connection in the order its requests were queued,
+    even when several CProcessZephyrRequestThread workers complete them out of order.
+    Replies of requests carrying a correlation id bypass the ordering through sendUnordered.
+    The lock only guards the reply state, the socket is written outside of it by one thread at a time : a thread
+    finding another one writing leaves its ready replies to it, so admit never waits on a slow client
+    '''
+    def __init__(self, connectionSocket):
+        '''
+        Initializing class member variables
+        :param connectionSocket:
+        '''
+        self.m_connectionSocket     = connectionSocket
+        self.m_lock                 = threading.Lock()
+        self.m_nextSequenceNumber   = 0
+        self.m_nextToSend           = 0
+        self.m_pendingReplies       = {}
+        self.m_readyReplies         = collections.deque()
+        self.m_isWriting            = False
+        self.m_inFlight             = 0
+        self.m_busyReplies          = 0
+
+    def admit(self, content, maxInFlight):
+        '''
+        Count a request of the connection as in flight until its reply is sent
+        :param content: CRequestData
+        :param maxInFlight: CONNECTION_MAX_IN_FLIGHT
+        :return: False when the connection already has maxInFlight requests queued or running
+        '''
+        with self.m_lock:
+            if self.m_inFlight >= maxInFlight:
+                return False
+            self.m_inFlight += 1
+            content.m_admitted = True
+            return True
+
+    def release(self, content):
+        '''
+        Stop counting an admitted request once it is answered
+        '''
+        with self.m_lock:
+            if content.m_admitted:
+                content.m_admitted = False
+                self.m_inFlight -= 1
+
+    def admitBusyReply(self, maxBusyReplies):
+        '''
+        Count a BUSY reply of the connection waiting for CBusyReplyThread
+        :param maxBusyReplies: CONNECTION_MAX_BUSY_REPLIES
+        :return: False when the connection already has maxBusyReplies of them, its client does not read its replies
+        '''
+        with self.m_lock:
+            if self.m_busyReplies >= maxBusyReplies:
+                return False
+            self.m_busyReplies += 1
+            return True
+
+    def releaseBusyReply(self):
+
+        with self.m_lock:
+            self.m_busyReplies -= 1
+
+    def nextSequenceNumber(self):
+        '''
+        Reserve the reply slot of a newly queued request
+        :return:
+        '''
+        with self.m_lock:
+            sequenceNumber = self.m_nextSequenceNumber
+            self.m_nextSequenceNumber += 1
+            return sequenceNumber
+
+    def send(self, sequenceNumber, msg):
+        '''
+        Send msg once every earlier reply is sent, otherwise park it
+        :param sequenceNumber:
+        :param msg: complete wire message or list of its chunks, None releases the slot without sending anything
+        :return:
+        '''
+        with self.m_lock:
+            self.m_pendingReplies[sequenceNumber] = msg
+            while self.m_nextToSend in self.m_pendingReplies:
+                pendingMsg = self.m_pendingReplies.pop(self.m_nextToSend)
+                self.m_nextToSend += 1
+                if pendingMsg is not None:
+                    self.m_readyReplies.append(pendingMsg)
+        self.writeReady()
+
+    def sendUnordered(self, msg):
+        '''
+        Send msg right away, it only waits for replies already being written so it does not interleave with them
+        :param msg: complete wire message or list of its chunks
+        :return:
+        '''
+        with self.m_lock:
+            self.m_readyReplies.append(msg)
+        self.writeReady()
+
+    def writeReady(self):
+        '''
+        Write the ready replies unless another thread is writing them already, the lock is not held while writing
+        '''
+        with self.m_lock:
+            if self.m_isWriting:
+                return
+            self.m_isWriting = True
+        isWriting = True
+        try:
+            while isWriting:
+                with self.m_lock:
+                    readyReplies = list(self.m_readyReplies)
+                    self.m_readyReplies.clear()
+                    # giving up the writer role under the lock, a reply readied meanwhile is not left unwritten
+                    isWriting = self.m_isWriting = len(readyReplies) > 0
+                for readyMsg in readyReplies:
+                    sendAll(self.m_connectionSocket, readyMsg)
+        finally:
+            if isWriting:
+                # the write failed, a later reply may try again
+                with self.m_lock:
+                    self.m_isWriting = False
+
+    def skip(self, sequenceNumber):
+        '''
+        Release the reply slot of a request that is not answered
+        :param sequenceNumber:
+        :return:
+        '''
+        self.send(sequenceNumber, None)
+
+class CBatchRequest:
+    '''
+    This class fans the items of one BATCH request out to the dispatcher workers, at most BATCH_MAX_PARALLELISM
+    of them queued or in flight at once, and answers the client with one JSON array of per item status and body
+    once every item is answered
+    '''
+    def __init__(self, content, items, replySender):
+        '''
+        Initializing class member variables
+        :param content: CRequestData of the BATCH request
+        :param items: list of {"method", "url", "data", "priority"} objects, data is base64 encoded like a protocol 1 request
+        :param replySender: called with (content, CProxyResponse) to answer the client
+        '''
+        self.m_content              = content
+        self.m_items                = items
+        self.m_replySender          = replySender
+        self.m_replies              = [None] * len(items)
+        self.m_lock                 = threading.Lock()
+        self.m_nextItem             = 0
+        self.m_pendingCount         = len(items)
+
+    def start(self):
+
+        Proxy_Metrics.increment("batch.requests")
+        Proxy_Metrics.increment("batch.items", len(self.m_items))
+        if len(self.m_items) == 0:
+            self.sendReply()
+            return
+        for count in range(0, min(BATCH_MAX_PARALLELISM, len(self.m_items))):
+            self.queueNextItem()
+
+    def queueNextItem(self):
+        '''
+        Queue the next item for the dispatcher workers, invalid items are answered with 400 right away
+        '''
+        while True:
+            with self.m_lock:
+                if self.m_nextItem >= len(self.m_items):
+                    return
+                index = self.m_nextItem
+                self.m_nextItem += 1
+            item = self.m_items[index]
+            if isinstance(item, dict) and item.get("method") in BATCH_ITEM_METHODS and item.get("url"):
+                Queue_Container.put(CRequestData(item["method"], item["url"], item.get("data", ""), self.m_content.m_connectionInfo,
+                                                 self.m_content.m_connectionSocket, self.m_content.socketStatus,
+                                                 replyHandler=lambda itemContent, proxyResponse: self.onItemReply(index, proxyResponse),
+                                                 priority=item.get("priority", self.m_content.m_priority), deadline=self.m_content.m_deadline,
+                                                 idempotencyKey=item.get("idempotencyKey")))
+                return
+            print ("Invalid batch item %s from %s" %(index, str(self.m_content.m_connectionInfo)))
+            if self.completeItem(index, CProxyResponse.error(400, "Invalid batch item %s" %index)):
+                return
+
+    def onItemReply(self, index, proxyResponse):
+
+        if not self.completeItem(index, proxyResponse):
+            self.queueNextItem()
+
+    def completeItem(self, index, proxyResponse):
+        '''
+        Store the reply of one item and answer the client after the last one
+        :return: True when the batch is complete
+        '''
+        self.m_replies[index] = proxyResponse
+        with self.m_lock:
+            self.m_pendingCount -= 1
+            isComplete = self.m_pendingCount == 0
+        if isComplete:
+            self.sendReply()
+        return isComplete
+
+    def sendReply(self):
+        '''
+        JSON item bodies are embedded as received, other bodies are base64 encoded in "payload"
+        '''
+        chunks = []
+        for proxyResponse in self.m_replies:
+            if proxyResponse is None:
+                chunks.append('{"httpStatusCode": 502, "body": null}')
+            elif proxyResponse.isJSON():
+                chunks.append('{"httpStatusCode": %d, "body": %s}' %(proxyResponse.m_statusCode, proxyResponse.m_body))
+            elif len(proxyResponse.m_body) > 0:
+                chunks.append('{"httpStatusCode": %d, "body": null, "payload": "%s"}' %(proxyResponse.m_statusCode, base64.b64encode(proxyResponse.m_body)))
+            else:
+                chunks.append('{"httpStatusCode": %d, "body": null}' %proxyResponse.m_statusCode)
+        self.m_replySender(self.m_content, CProxyResponse(200, CONTENT_TYPE, "[" + ", ".join(chunks) + "]"))
+
+class CUpstreamConnectionMixin(object):
+    '''
+    Counts TCP/TLS handshakes of zephyr connections
+    '''
+    def connect(self):
+
+        Proxy_Metrics.increment("upstream.connections.new")
+        super(CUpstreamConnectionMixin, self).connect()
+
+class CUpstreamHTTPConnection(CUpstreamConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class CUpstreamHTTPSConnection(CUpstreamConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class CUpstreamConnectionPoolMixin(object):
+    '''
+    Counts reused connections and closes keep-alive connections idle for more than UPSTREAM_POOL_IDLE_TIMEOUT,
+    zephyr may already have dropped them
+    '''
+    def _get_conn(self, timeout=None):
+
+        conn = super(CUpstreamConnectionPoolMixin, self)._get_conn(timeout)
+        lastUsed = getattr(conn, "m_lastUsed", None)
+        if lastUsed is not None and conn.sock is not None:
+            if time.time() - lastUsed > UPSTREAM_POOL_IDLE_TIMEOUT:
+                conn.close()
+                Proxy_Metrics.increment("upstream.connections.idle_evicted")
+            else:
+                Proxy_Metrics.increment("upstream.connections.reused")
+        return conn
+
+    def _put_conn(self, conn):
+
+        if conn is not None:
+            conn.m_lastUsed = time.time()
+        super(CUpstreamConnectionPoolMixin, self)._put_conn(conn)
+
+    def evictIdle(self):
+        '''
+        Close idle connections waiting in the pool
+        :return: number of connections left open
+        '''
+        openCount = 0
+        currentTime = time.time()
+        # LifoQueue.mutex keeps _get_conn from taking a connection while it is closed
+        with self.pool.mutex:
+            for conn in self.pool.queue:
+                if conn is None or conn.sock is None:
+                    continue
+                if currentTime - getattr(conn, "m_lastUsed", currentTime) > UPSTREAM_POOL_IDLE_TIMEOUT:
+                    conn.close()
+                    Proxy_Metrics.increment("upstream.connections.idle_evicted")
+                else:
+                    openCount += 1
+        return openCount
+
+class CUpstreamHTTPConnectionPool(CUpstreamConnectionPoolMixin, urllib3.connectionpool.HTTPConnectionPool):
+
+    ConnectionCls = CUpstreamHTTPConnection
+
+class CUpstreamHTTPSConnectionPool(CUpstreamConnectionPoolMixin, urllib3.connectionpool.HTTPSConnectionPool):
+
+    ConnectionCls = CUpstreamHTTPSConnection
+
+class CUpstreamHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+
+        requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CUpstreamHTTPConnectionPool, "https": CUpstreamHTTPSConnectionPool}
+
+class CUpstreamConnectionPool:
+    '''
+    This class owns the zephyr connections shared by every dispatcher worker. Each thread gets its own
+    requests session since sessions are not thread safe, all of them mount one adapter whose urllib3 pools are
+    shared, so connections are reused across workers and maxPerHost caps the connections to each zephyr host
+    '''
+    def __init__(self, maxHosts, maxPerHost):
+        '''
+        Initializing class member variables
+        :param maxHosts: zephyr hosts whose connection pools are kept
+        :param maxPerHost: connections per host, further requests wait for a free connection
+        '''
+        self.m_adapter          = CUpstreamHTTPAdapter(pool_connections=maxHosts, pool_maxsize=maxPerHost, pool_block=True)
+        self.m_threadLocal      = threading.local()
+
+    def getSession(self, headers):
+        '''
+        Returns the session of the calling thread
+        :param headers: headers sent with every request of a new session
+        :return:
+        '''
+        session = getattr(self.m_threadLocal, "session", None)
+        if session is None:
+            session = requests.session()
+            session.mount("http://", self.m_adapter)
+            session.mount("https://", self.m_adapter)
+            session.headers.update(headers)
+            self.m_threadLocal.session = session
+        return session
+
+    def evictIdle(self):
+        '''
+        Close idle connections of every host pool, called periodically so unused connections do not linger
+        '''
+        try:
+            pools = self.m_adapter.poolmanager.pools
+            openCount = 0
+            for poolKey in pools.keys():
+                pool = pools.get(poolKey)
+                if pool is not None:
+                    openCount += pool.evictIdle()
+            Proxy_Metrics.setGauge("upstream.connections.idle_open", openCount)
+        except Exception as exp:
+            print("Exception in CUpstreamConnectionPool::evictIdle : %s" %exp)
+
+Upstream_Pool               = CUpstreamConnectionPool(UPSTREAM_POOL_MAX_HOSTS, UPSTREAM_POOL_MAX_PER_HOST)
+
+class CTokenBucket:
+    '''
+    This class hands out tokensPerSecond tokens per second, up to burst of them at once
+    '''
+    def __init__(self, tokensPerSecond, burst):
+
+        self.m_lock             = threading.Lock()
+        self.m_tokensPerSecond  = float(tokensPerSecond)
+        self.m_burst            = float(burst)
+        self.m_tokens           = float(burst)
+        self.m_updatedAt        = time.time()
+
+    def reserve(self):
+        '''
+        Take one token, going into debt when none is left so waiting callers are served in arrival order
+        :return: seconds to wait before the token may be used
+        '''
+        with self.m_lock:
+            currentTime = time.time()
+            self.m_tokens = min(self.m_burst, self.m_tokens + (currentTime - self.m_updatedAt) * self.m_tokensPerSecond)
+            self.m_updatedAt = currentTime
+            self.m_tokens -= 1
+            if self.m_tokens >= 0:
+                return 0.0
+            return -self.m_tokens / self.m_tokensPerSecond
+
+class CRateLimiter:
+    '''
+    This class paces calls to zephyr : every call needs a token of the global bucket and urls of a
+    RATE_LIMIT_FAMILY_RULES family first need a token of that family's bucket
+    '''
+    def __init__(self, tokensPerSecond, burst, familyRules):
+        '''
+        Initializing class member variables
+        :param tokensPerSecond:
+        :param burst:
+        :param familyRules: list of (url part, tokens per second, burst)
+        '''
+        self.m_globalBucket     = CTokenBucket(tokensPerSecond, burst)
+        self.m_familyBuckets    = [(urlPart, CTokenBucket(familyTokensPerSecond, familyBurst)) for urlPart, familyTokensPerSecond, familyBurst in familyRules]
+
+    def acquire(self, url):
+        '''
+        Block the calling worker until url may be sent to zephyr
+        :param url:
+        :return: seconds waited
+        '''
+        waitedSeconds = 0.0
+        family = "global"
+        for urlPart, bucket in self.m_familyBuckets:
+            if urlPart in url:
+                family = urlPart
+                waitedSeconds += self.wait(bucket)
+                break
+        # the global token is only reserved once the family allows the call, a throttled family does not hold it
+        waitedSeconds += self.wait(self.m_globalBucket)
+        if waitedSeconds > 0:
+            Proxy_Metrics.increment("ratelimit.waits.%s" %family)
+            Proxy_Metrics.increment("ratelimit.wait_seconds.%s" %family, waitedSeconds)
+        return waitedSeconds
+
+    def wait(self, bucket):
+
+        waitSeconds = bucket.reserve()
+        if waitSeconds > 0:
+            time.sleep(waitSeconds)
+        return waitSeconds
+
+Upstream_Rate_Limiter       = CRateLimiter(RATE_LIMIT_TOKENS_PER_SECOND, RATE_LIMIT_BURST, RATE_LIMIT_FAMILY_RULES)
+
+class CAdaptiveConcurrencyLimit:
+    '''
+    This class limits concurrent zephyr calls with additive increase / multiplicative decrease : after every
+    window of completed calls the limit grows by one when it was reached and latency stayed flat, and shrinks
+    by ADAPTIVE_CONCURRENCY_BACKOFF when the p90 latency rose above the baseline or calls failed.
+    The baseline is the lowest window p90 of the last windows, so it follows slow changes of zephyr itself
+    '''
+    def __init__(self, initialLimit, minLimit, maxLimit, windowSize):
+        '''
+        Initializing class member variables
+        :param initialLimit:
+        :param minLimit:
+        :param maxLimit:
+        :param windowSize: completed calls between two limit adjustments
+        '''
+        self.m_condition        = threading.Condition()
+        self.m_limit            = float(initialLimit)
+        self.m_minLimit         = minLimit
+        self.m_maxLimit         = maxLimit
+        self.m_windowSize       = windowSize
+        self.m_inFlight         = 0
+        self.m_peakInFlight     = 0
+        self.m_latencies        = []
+        self.m_failureCount     = 0
+        self.m_baselines        = collections.deque(maxlen=10)
+        Proxy_Metrics.setGauge("upstream.concurrency_limit", int(self.m_limit))
+
+    def acquire(self):
+        '''
+        Block the calling worker until a zephyr call slot is free
+        '''
+        with self.m_condition:
+            while self.m_inFlight >= int(self.m_limit):
+                self.m_condition.wait()
+            self.m_inFlight += 1
+            self.m_peakInFlight = max(self.m_peakInFlight, self.m_inFlight)
+            Proxy_Metrics.setGauge("upstream.in_flight", self.m_inFlight)
+
+    def release(self, latency, isFailure):
+        '''
+        Free the slot of a completed zephyr call
+        :param latency: seconds the call took
+        :param isFailure: zephyr answered 5xx or did not answer
+        '''
+        with self.m_condition:
+            self.m_inFlight -= 1
+            self.m_latencies.append(latency)
+            if isFailure:
+                self.m_failureCount += 1
+            if len(self.m_latencies) >= self.m_windowSize:
+                self.adjustLimit()
+            Proxy_Metrics.setGauge("upstream.in_flight", self.m_inFlight)
+            self.m_condition.notify_all()
+
+    def adjustLimit(self):
+        '''
+        Move the limit from the statistics of the finished window, caller holds self.m_condition
+        '''
+        latencies = sorted(self.m_latencies)
+        p90 = latencies[int(0.9 * (len(latencies) - 1))]
+        baseline = min(self.m_baselines) if len(self.m_baselines) > 0 else p90
+        self.m_baselines.append(p90)
+        if self.m_failureCount > ADAPTIVE_CONCURRENCY_ERROR_RATIO * len(latencies) or p90 > baseline * ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE:
+            self.m_limit = max(self.m_minLimit, self.m_limit * ADAPTIVE_CONCURRENCY_BACKOFF)
+            Proxy_Metrics.increment("upstream.concurrency_decreases")
+        elif self.m_peakInFlight >= int(self.m_limit):
+            # only grow a limit that is actually used
+            self.m_limit = min(self.m_maxLimit, self.m_limit + 1)
+        self.m_latencies = []
+        self.m_failureCount = 0
+        self.m_peakInFlight = self.m_inFlight
+        Proxy_Metrics.setGauge("upstream.concurrency_limit", int(self.m_limit))
+        Proxy_Metrics.setGauge("upstream.latency_p90_ms", int(p90 * 1000))
+
+class CCircuitBreaker:
+    '''
+    This class stops calls to zephyr while it is down : after failureThreshold consecutive failed calls the circuit
+    opens and calls are rejected for openSeconds, then a single trial call decides whether it closes again
+    '''
+    def __init__(self, failureThreshold, openSeconds):
+
+        self.m_lock             = threading.Lock()
+        self.m_failureThreshold = failureThreshold
+        self.m_openSeconds      = openSeconds
+        self.m_failureCount     = 0
+        self.m_openedAt         = None
+        self.m_trialInFlight    = False
+
+    def allowRequest(self):
+        '''
+        Returns False while the circuit is open
+        '''
+        with self.m_lock:
+            if self.m_openedAt is None:
+                return True
+            if self.m_trialInFlight or time.time() - self.m_openedAt < self.m_openSeconds:
+                return False
+            self.m_trialInFlight = True
+            return True
+
+    def recordSuccess(self):
+
+        with self.m_lock:
+            if self.m_openedAt is not None:
+                print ("Zephyr answered again, closing the circuit")
+                Proxy_Metrics.setGauge("circuit.open", 0)
+            self.m_failureCount = 0
+            self.m_openedAt = None
+            self.m_trialInFlight = False
+
+    def recordFailure(self):
+
+        with self.m_lock:
+            self.m_failureCount += 1
+            if self.m_trialInFlight or (self.m_openedAt is None and self.m_failureCount >= self.m_failureThreshold):
+                print ("Zephyr failed %s calls in a row, opening the circuit for %s seconds" %(self.m_failureCount, self.m_openSeconds))
+                Proxy_Metrics.increment("circuit.opened")
+                Proxy_Metrics.setGauge("circuit.open", 1)
+                self.m_openedAt = time.time()
+            self.m_trialInFlight = False
+
+    def recordAbandoned(self):
+        '''
+        Free the trial slot of a call that tells nothing about zephyr health, e.g. one cut short by a client deadline
+        '''
+        with self.m_lock:
+            self.m_trialInFlight = False
+
+Circuit_Breaker             = CCircuitBreaker(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_OPEN_SECONDS)
+
+Upstream_Concurrency_Limit  = CAdaptiveConcurrencyLimit(ADAPTIVE_CONCURRENCY_INITIAL, ADAPTIVE_CONCURRENCY_MIN, ADAPTIVE_CONCURRENCY_MAX,
+                                                        ADAPTIVE_CONCURRENCY_WINDOW)
+
+class CHedgingPolicy:
+    '''
+    This class decides when a GET gets a second identical request : once it has taken longer than the HEDGE_PERCENTILE
+    latency of its url template. Every GET earns HEDGE_MAX_RATIO of a hedge, up to HEDGE_BURST, so hedging can not
+    double the zephyr load when zephyr is slow as a whole
+    '''
+    def __init__(self, percentile, minDelay, maxRatio, burst, windowSize, minSamples):
+        '''
+        Initializing class member variables
+        '''
+        self.m_lock             = threading.Lock()
+        self.m_percentile       = percentile
+        self.m_minDelay         = minDelay
+        self.m_maxRatio         = float(maxRatio)
+        self.m_burst            = float(burst)
+        self.m_budget           = float(burst)
+        self.m_windowSize       = windowSize
+        self.m_minSamples       = minSamples
+        self.m_latencies        = {}                # url template -> deque of the latest latencies
+        self.m_getCount         = 0
+        self.m_hedgeCount       = 0
+
+    def getTemplate(self, requestURL):
+
+        return Response_Cache.getTemplate(requestURL) or "other"
+
+    def getDelay(self, requestURL):
+        '''
+        Count one GET and return the seconds to wait for it before hedging
+        :param requestURL:
+        :return: None while fewer than HEDGE_MIN_SAMPLES latencies of the url template are known
+        '''
+        with self.m_lock:
+            self.m_getCount += 1
+            self.m_budget = min(self.m_burst, self.m_budget + self.m_maxRatio)
+            latencies = self.m_latencies.get(self.getTemplate(requestURL))
+            if latencies is None or len(latencies) < self.m_minSamples:
+                return None
+            orderedLatencies = sorted(latencies)
+        index = min(len(orderedLatencies) - 1, int(len(orderedLatencies) * self.m_percentile / 100.0))
+        return max(self.m_minDelay, orderedLatencies[index])
+
+    def recordLatency(self, requestURL, seconds):
+
+        template = self.getTemplate(requestURL)
+        with self.m_lock:
+            latencies = self.m_latencies.get(template)
+            if latencies is None:
+                latencies = self.m_latencies[template] = collections.deque(maxlen=self.m_windowSize)
+            latencies.append(seconds)
+
+    def tryHedge(self):
+        '''
+        Spend one hedge of the budget
+        :return: False when the hedge budget is used up
+        '''
+        with self.m_lock:
+            if self.m_budget < 1:
+                isAllowed = False
+            else:
+                isAllowed = True
+                self.m_budget -= 1
+                self.m_hedgeCount += 1
+            hedgeRate = self.m_hedgeCount / float(max(1, self.m_getCount))
+        Proxy_Metrics.setGauge("hedge.rate", hedgeRate)
+        Proxy_Metrics.increment("hedge.sent" if isAllowed else "hedge.suppressed")
+        return isAllowed
+
+Hedging_Policy              = CHedgingPolicy(HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MAX_RATIO, HEDGE_BURST, HEDGE_LATENCY_WINDOW,
+                                             HEDGE_MIN_SAMPLES)
+
+class CHedgeExecutor:
+    '''
+    This class runs the attempts of hedged GETs on reusable daemon threads, so their requests sessions outlive
+    one GET. A thread is added whenever every existing one is busy, dropped attempts may keep one busy until
+    UPSTREAM_TIMEOUT
+    '''
+    def __init__(self):
+        '''
+        Initializing class member variables
+        '''
+        self.m_lock             = threading.Lock()
+        self.m_tasks            = Queue.Queue()
+        self.m_idleCount        = 0
+        self.m_threadCount      = 0
+
+    def submit(self, task, *args):
+
+        with self.m_lock:
+            if self.m_idleCount > 0:
+                self.m_idleCount -= 1
+            else:
+                self.m_threadCount += 1
+                thread = threading.Thread(target=self.runTasks, name="HedgeExecutor-%d" %self.m_threadCount)
+                thread.daemon = True
+                thread.start()
+                Proxy_Metrics.setGauge("hedge.threads", self.m_threadCount)
+        self.m_tasks.put((task, args))
+
+    def runTasks(self):
+
+        while True:
+            task, args = self.m_tasks.get()
+            try:
+                task(*args)
+            except Exception as exp:
+                print("Exception in CHedgeExecutor::runTasks : %s" %exp)
+            with self.m_lock:
+                self.m_idleCount += 1
+
+Hedge_Executor              = CHedgeExecutor()
+
+class CDeadlineExpiredError(Exception):
+    pass
+
+class CHttpClass:
+    '''
+    This class process http request get/post/put
+    '''
+    def __init__(self):
+        '''
+        Initializing class member variables in constructor
+        '''
+        self._userName                      = USERNAME
+        self._password                      = PASSWORD
+        self._contentType                   = CONTENT_TYPE
+        self._encoded_login                 = base64.b64encode(b"%s:%s" %(self._userName, self._password))
+        self._authorization                 = "Basic %s" %(self._encoded_login)
+        self._threadState                   = threading.local()
+
+    def getAuthorization(self):
+
+        return self._authorization
+
+    def setDeadline(self, deadline):
+        '''
+        Deadline of the client request served by the calling thread, zephyr calls made for it get the remaining time as timeout
+        :param deadline: epoch seconds, None for UPSTREAM_TIMEOUT only
+        :return:
+        '''
+        self._threadState.deadline = deadline
+
+    def getUpstreamTimeout(self):
+        '''
+        Returns UPSTREAM_TIMEOUT capped by the time left until the deadline of the calling thread
+        '''
+        deadline = getattr(self._threadState, "deadline", None)
+        if deadline is None:
+            return UPSTREAM_TIMEOUT
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise CDeadlineExpiredError("Deadline expired before zephyr was called")
+        return min(UPSTREAM_TIMEOUT, remaining)
+
+    def getLastError(self):
+        '''
+        Returns (status code, message, is unsent) explaining why the last call of the calling thread returned None,
+        is unsent tells the request never reached zephyr so sending it again can not apply it twice
+        '''
+        return getattr(self._threadState, "lastError", None) or (502, "No response from zephyr", False)
+
+    def getHttpSession(self):
+        '''
+        Returns the http session of the calling thread, its connections come from Upstream_Pool
+        :return:
+        '''
+        try:
+            return Upstream_Pool.getSession({"Authorization":"%s" %self._authorization, "Content-Type":"%s" %self._contentType })
+        except Exception as exp:
+            print("Exception in CHttpClass::getHttpSession : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return None
+
+    def sendRequest(self, method, requestURL, **kwargs):
+        '''
+        Send one request to zephyr unless the circuit breaker is open
+        :param method:
+        :param requestURL:
+        :param kwargs: passed to requests
+        :return: response, None when zephyr was not called or did not answer, getLastError tells why
+        '''
+        self._threadState.lastError = None
+        if not Circuit_Breaker.allowRequest():
+            Proxy_Metrics.increment("circuit.rejected")
+            self._threadState.lastError = (503, "Zephyr is unavailable, request rejected by the proxy circuit breaker", True)
+            return None
+        self._threadState.timeout = UPSTREAM_TIMEOUT
+        try:
+            response = self.callZephyr(method, requestURL, **kwargs)
+        except CDeadlineExpiredError as exp:
+            # the client gave up, zephyr is not to blame
+            Circuit_Breaker.recordAbandoned()
+            Proxy_Metrics.increment("deadline.expired.upstream")
+            self._threadState.lastError = (504, str(exp), True)
+            return None
+        except requests.exceptions.Timeout as exp:
+            print("Timeout in CHttpClass::sendRequest : %s" %exp)
+            if self._threadState.timeout >= UPSTREAM_TIMEOUT:
+                Circuit_Breaker.recordFailure()
+            else:
+                Circuit_Breaker.recordAbandoned()
+                Proxy_Metrics.increment("deadline.expired.upstream")
+            self._threadState.lastError = (504, "Zephyr did not answer within %.1f seconds" %self._threadState.timeout, False)
+            return None
+        except Exception as exp:
+            print("Exception in CHttpClass::sendRequest : %s" %exp)
+            Circuit_Breaker.recordFailure()
+            self._threadState.lastError = (502, "Zephyr request failed : %s" %exp, False)
+            return None
+        if response.status_code >= 500:
+            Circuit_Breaker.recordFailure()
+        else:
+            Circuit_Breaker.recordSuccess()
+        return response
+
+    def callZephyr(self, method, requestURL, **kwargs):
+        '''
+        Send one request to zephyr once the rate limit and the adaptive concurrency limit allow it
+        :param method:
+        :param requestURL:
+        :param kwargs: passed to requests
+        :return:
+        '''
+        if RATE_LIMIT_ENABLED:
+            Upstream_Rate_Limiter.acquire(requestURL)
+        if not ADAPTIVE_CONCURRENCY_ENABLED:
+            self._threadState.timeout = self.getUpstreamTimeout()
+            return self.getHttpSession().request(method, requestURL, timeout=self._threadState.timeout, **kwargs)
+        Upstream_Concurrency_Limit.acquire()
+        startTime = time.time()
+        isFailure = True
+        try:
+            # the limits may have held the request back, the timeout is taken once it is really sent
+            self._threadState.timeout = self.getUpstreamTimeout()
+            response = self.getHttpSession().request(method, requestURL, timeout=self._threadState.timeout, **kwargs)
+            isFailure = response.status_code >= 500
+            return response
+        finally:
+            Upstream_Concurrency_Limit.release(time.time() - startTime, isFailure)
+
+    def sendTimedGet(self, requestURL, headers):
+        '''
+        Send one GET through sendRequest and feed its latency to Hedging_Policy
+        '''
+        startTime = time.time()
+        response = self.sendRequest("GET", requestURL, headers=headers)
+        if response is not None and response.status_code < 500:
+            Hedging_Policy.recordLatency(requestURL, time.time() - startTime)
+        return response
+
+    def sendHedgedGet(self, requestURL, headers):
+        '''
+        Send a GET and, when it is slower than Hedging_Policy allows, a second identical one : the first successful
+        answer is used, the other request completes in the background and is dropped
+        :param requestURL:
+        :param headers:
+        :return: response, None when neither request was answered, getLastError tells why
+        '''
+        delay = Hedging_Policy.getDelay(requestURL)
+        if delay is None:
+            return self.sendTimedGet(requestURL, headers)
+        results = Queue.Queue()
+        deadline = getattr(self._threadState, "deadline", None)
+
+        def sendAttempt(isHedge):
+            # runs on a Hedge_Executor thread, the deadline and the last error are per thread
+            self.setDeadline(deadline)
+            response = self.sendTimedGet(requestURL, headers)
+            results.put((isHedge, response, None if response is not None else self.getLastError()))
+
+        # an attempt whose thread died never puts its result, the wait ends with the deadline or UPSTREAM_TIMEOUT
+        waitUntil = deadline if deadline is not None else time.time() + UPSTREAM_TIMEOUT
+        Hedge_Executor.submit(sendAttempt, False)
+        attemptCount = 1
+        try:
+            try:
+                result = results.get(True, delay)
+            except Queue.Empty:
+                if Hedging_Policy.tryHedge():
+                    Hedge_Executor.submit(sendAttempt, True)
+                    attemptCount += 1
+                result = results.get(True, max(0, waitUntil - time.time()))
+        except Queue.Empty:
+            Proxy_Metrics.increment("hedge.unanswered")
+            self._threadState.lastError = (504, "Zephyr did not answer in time", True)
+            return None
+        isHedge, response, lastError = result
+        if (response is None or response.status_code >= 500) and attemptCount > 1:
+            # the first answer failed, the other request may still succeed
+            try:
+                isHedge, response, lastError = results.get(True, max(0, waitUntil - time.time()))
+            except Queue.Empty:
+                pass
+        if isHedge and response is not None:
+            Proxy_Metrics.increment("hedge.won")
+        self._threadState.lastError = lastError
+        return response
+
+    def get(self, requestURL, cachedResponse=None):
+        '''
+        Process get http method
+        :param requestURL:
+        :param cachedResponse: expired CProxyResponse whose ETag/Last-Modified make the request conditional
+        :return:
+        '''
+        try:
+            print ("CHttpClass : get : %s" %requestURL)
+            headers = {}
+            if cachedResponse is not None:
+                if cachedResponse.m_etag is not None:
+                    headers["If-None-Match"] = cachedResponse.m_etag
+                if cachedResponse.m_lastModified is not None:
+                    headers["If-Modified-Since"] = cachedResponse.m_lastModified
+            for attempt in range(0, UPSTREAM_GET_RETRY_COUNT + 1):
+                if attempt > 0:
+                    Proxy_Metrics.increment("upstream.retries")
+                    time.sleep(random.uniform(0, min(UPSTREAM_RETRY_MAX_BACKOFF, UPSTREAM_RETRY_BASE_BACKOFF * (2 ** attempt))))
+                if HEDGING_ENABLED:
+                    response = self.sendHedgedGet(requestURL, headers)
+                else:
+                    response = self.sendRequest("GET", requestURL, headers=headers)
+                if response is not None and response.status_code not in UPSTREAM_RETRY_STATUS_CODES:
+                    break
+                if response is None and self.getLastError()[0] == 503:
+                    # circuit is open, retrying would only be rejected again
+                    break
+                deadline = getattr(self._threadState, "deadline", None)
+                if deadline is not None and time.time() >= deadline:
+                    break
+            return response
+        except Exception as exp:
+            print("Exception in CHttpClass::get : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return None
+
+    def put(self, putURL, values=None):
+        '''
+        Process put http method
+        :param putURL:
+        :param values:
+        :return:
+        '''
+        try:
+            print ("CHttpClass : put : %s & values : %s" %(putURL,values))
+            response = self.sendRequest("PUT", putURL, data = values)
+            return response
+        except Exception as exp:
+            print("Exception in CHttpClass::put : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return None
+
+    def post(self, postURL, values=None):
+        '''
+        Process post http method
+        :param postURL:
+        :param values:
+        :return:
+        '''
+        try:
+            print ("CHttpClass : post : %s & values : %s" %(postURL, values))
+            response = self.sendRequest("POST", postURL, data=values)
+            return response
+        except Exception as exp:
+            print("Exception in CHttpClass::post : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return None
+
+
+
+class CProcessZephyrRequestThread (threading.Thread):
+    '''
+    This class is responsible for processing client request received and queued in shared queue by
+    CReceiverZephyrRequestThread  and sending it's response
+    back to associated clients. DISPATCHER_WORKER_COUNT instances drain Queue_Container concurrently,
+    each one with its own CHttpClass session
+    '''
+    def __init__(self, pthreadID, pthreadName):
+        '''
+        Initializing base class(thread) and class member variables
+        :param pthreadID:
+        :param pthreadName:
+        '''
+        threading.Thread.__init__(self)
+        self.m_threadID           = pthreadID
+        self.m_name               = pthreadName
+        self.m_httpObj            = CHttpClass()
+
+    def run(self):
+        '''
+        Thread callback function
+        :return:
+        '''
+        global exitFlag
+
+        try:
+            print ("CProcessZephyrRequest: Starting " + self.m_name)
+            while exitFlag is False:
+                # Block until a request is queued, UserInput queues one None per worker on exit
+                content = Queue_Container.get()
+                if content is None:
+                    break
+                try:
+                    self.processRequest(content)
+                except Exception as exp:
+                    # one broken request must neither stop this worker nor leave its client waiting
+                    print("Exception in CProcessZephyrRequest::processRequest : %s" %exp)
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    print(exc_type, exc_obj, exc_tb.tb_lineno)
+                    self.sendError(content, 500, "Proxy failed to process the request : %s" %exp)
+            print "CProcessZephyrRequest Exiting " + self.m_name
+        except Exception as exp:
+            print("Exception in CProcessZephyrRequest::run : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return
+
+    def processRequest(self, content):
+        '''
+        Forward one queued client request to zephyr and reply to the client
+        :param content: CRequestData
+        :return:
+        '''
+        response = None
+
+        print ("CProcessZephyrRequest Data : " + ("None" if content.m_httpURL is None else content.m_httpURL))
+        print ("CProcessZephyrRequest  : %s %s %s %s" %(self.m_name, content.m_methodType , content.m_connectionInfo[0] , content.m_connectionInfo[1]))
+
+        if content.isExpired():
+            # the client stopped waiting while the request was queued, do not spend a zephyr call on it
+            Proxy_Metrics.increment("deadline.expired.queued")
+            self.sendError(content, 504, "Deadline expired after %.1f seconds in the proxy queue" %(time.time() - content.m_queuedAt), True)
+            return
+        self.m_httpObj.setDeadline(content.m_deadline)
+
+        if content.m_idempotencyKey is not None and content.m_methodType in ["POST", "PUT"] and not Idempotency_Table.begin(content):
+            return
+        if WRITE_BEHIND_ENABLED and Write_Behind_Journal.isJournaled(content.m_methodType, content.m_httpURL) and self.processJournaledWrite(content):
+            return
+
+        if content.m_methodType == "GET":
+            self.processGetRequest(content)
+            return
+        elif (content.m_methodType == "BATCH"):
+            self.processBatchRequest(content)
+            return
+        elif (content.m_methodType == "POST"):
+            if POST_AGGREGATION_ENABLED and content.m_isMergeable and any(content.m_httpURL.endswith(url) for url in POST_AGGREGATION_URLS):
+                self.processAggregatedPost(content)
+                return
+            response = self.m_httpObj.post(content.m_httpURL, content.getRequestBody())
+            Response_Cache.invalidate(content.m_httpURL)
+        elif (content.m_methodType == "PUT"):
+            response = self.m_httpObj.put(content.m_httpURL, content.getRequestBody())
+            Response_Cache.invalidate(content.m_httpURL)
+        elif (content.m_methodType == "EXIT"):
+            print ("Closing TCP connection from %s on port number %s" %(content.m_connectionInfo[0], content.m_connectionInfo[1]))
+            content.socketStatus = False
+            self.skipResponse(content)
+            return
+        else:
+            print ("HTTP METHOD TYPE IS NOT VALID")
+            self.sendError(content, 400, "Invalid method %s" %content.m_methodType, True)
+            return
+        if response is None:
+            print ("No response for content.m_httpURL : %s" %content.m_httpURL)
+            self.sendError(content, *self.m_httpObj.getLastError())
+            return
+        print ("Response: %s" %response.status_code)
+        self.sendResponse(content, CProxyResponse.fromHttpResponse(response))
+
+    def processGetRequest(self, content):
+        '''
+        Answer a GET from Response_Cache or fetch it from zephyr and cache the reply
+        :param content: CRequestData
+        :return:
+        '''
+        cacheKey = (self.m_httpObj.getAuthorization(), content.m_httpURL)
+        if RESPONSE_CACHE_ENABLED:
+            proxyResponse = Response_Cache.get(cacheKey)
+            if proxyResponse is not None:
+                print ("Cache hit : %s" %content.m_httpURL)
+                self.sendResponse(content, proxyResponse)
+                return
+
+        if SINGLE_FLIGHT_ENABLED and not Single_Flight.join(cacheKey, content):
+            print ("Attached to in-flight GET : %s" %content.m_httpURL)
+            return
+
+        waiters = []
+        cacheGeneration = Response_Cache.getGeneration(content.m_httpURL)
+        staleResponse = Response_Cache.getStale(cacheKey) if RESPONSE_CACHE_ENABLED else None
+        try:
+            response = self.m_httpObj.get(content.m_httpURL, staleResponse)
+        except Exception as exp:
+            # the leader is answered by the worker, the attached requests only wait on it
+            if SINGLE_FLIGHT_ENABLED:
+                for waiter in Single_Flight.complete(cacheKey):
+                    self.sendError(waiter, 502, "Proxy failed to fetch the request : %s" %exp)
+            raise
+        if SINGLE_FLIGHT_ENABLED:
+            waiters = Single_Flight.complete(cacheKey)
+        if response is None:
+            print ("No response for content.m_httpURL : %s" %content.m_httpURL)
+            statusCode, message, isUnsent = self.m_httpObj.getLastError()
+            for waiter in [content] + waiters:
+                self.sendError(waiter, statusCode, message, isUnsent)
+            return
+        print ("Response: %s" %response.status_code)
+        if response.status_code == 304 and staleResponse is not None:
+            proxyResponse = staleResponse.revalidated(response)
+            template = Response_Cache.getTemplate(content.m_httpURL)
+            Proxy_Metrics.increment("revalidation.not_modified.%s" %template)
+            Proxy_Metrics.increment("revalidation.bytes_saved.%s" %template, len(proxyResponse.m_body))
+            Response_Cache.put(cacheKey, proxyResponse, cacheGeneration, True)
+        else:
+            if staleResponse is not None:
+                Proxy_Metrics.increment("revalidation.modified.%s" %Response_Cache.getTemplate(content.m_httpURL))
+            proxyResponse = CProxyResponse.fromHttpResponse(response)
+            if RESPONSE_CACHE_ENABLED:
+                Response_Cache.put(cacheKey, proxyResponse, cacheGeneration)
+        for waiter in [content] + waiters:
+            self.sendResponse(waiter, proxyResponse)
+
+    def processJournaledWrite(self, content):
+        '''
+        Acknowledge a write once Write_Behind_Journal holds it, CWriteBehindFlusherThread sends it to zephyr later
+        :param content: CRequestData
+        :return: False when the write could not be journaled and must be sent to zephyr now
+        '''
+        try:
+            sequence = Write_Behind_Journal.append(content.m_methodType, content.m_httpURL, content.getRequestBody())
+        except Exception as exp:
+            print("Exception in CProcessZephyrRequest::processJournaledWrite : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return False
+        print ("Journaled write %s : %s" %(sequence, content.m_httpURL))
+        self.sendResponse(content, CProxyResponse(200, CONTENT_TYPE, json.dumps({"journaled": True, "sequence": sequence})))
+        return True
+
+    def processAggregatedPost(self, content):
+        '''
+        Merge a POST of a JSON array with concurrent POSTs to the same url, the leader of the merge posts it to zephyr
+        and splits the reply array back per caller
+        :param content: CRequestData
+        :return:
+        '''
+        body = content.getRequestBody()
+        try:
+            items = json.loads(body or "")
+        except ValueError:
+            items = None
+        if not isinstance(items, list) or len(items) == 0:
+            callers = [(content, None)]
+        else:
+            callers = Post_Aggregator.join((self.m_httpObj.getAuthorization(), content.m_httpURL), content, items)
+            if callers is None:
+                print ("Merged POST : %s" %content.m_httpURL)
+                return
+        if len(callers) == 1:
+            response = self.m_httpObj.post(content.m_httpURL, body)
+            Response_Cache.invalidate(content.m_httpURL)
+            if response is None:
+                self.sendError(content, *self.m_httpObj.getLastError())
+            else:
+                self.sendResponse(content, CProxyResponse.fromHttpResponse(response))
+            return
+
+        answeredCallers = []
+        try:
+            self.sendMergedPost(content.m_httpURL, callers, answeredCallers)
+        except Exception as exp:
+            # the other callers only wait on the leader, none of them may be left without an answer
+            print("Exception in CProcessZephyrRequest::processAggregatedPost : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            for caller, callerItems in callers:
+                if caller not in answeredCallers:
+                    self.sendError(caller, 500, "Proxy failed to process the merged request : %s" %exp)
+
+    def sendMergedPost(self, url, callers, answeredCallers):
+        '''
+        Post the arrays of every merged caller as one array and answer each caller with its slice of the reply.
+        A merged array zephyr never saw or refused as invalid is posted again per caller, so one caller's
+        bad items do not fail the others, an applied one is never posted again
+        :param url:
+        :param callers: list of (CRequestData, items) returned by Post_Aggregator.join
+        :param answeredCallers: every answered or requeued caller is appended to it
+        :return:
+        '''
+        # the merged POST may take as long as the most patient caller allows
+        deadlines = [caller.m_deadline for caller, callerItems in callers]
+        self.m_httpObj.setDeadline(None if None in deadlines else max(deadlines))
+        mergedItems = [item for caller, callerItems in callers for item in callerItems]
+        print ("Sending %s merged POSTs with %s items : %s" %(len(callers), len(mergedItems), url))
+        Proxy_Metrics.increment("aggregation.upstream_posts")
+        Proxy_Metrics.increment("aggregation.saved", len(callers) - 1)
+        response = self.m_httpObj.post(url, json.dumps(mergedItems))
+        Response_Cache.invalidate(url)
+        if response is None:
+            statusCode, message, isUnsent = self.m_httpObj.getLastError()
+            if isUnsent:
+                # zephyr never saw the merged array, the workers post every array on its own
+                self.requeueUnmerged(callers, answeredCallers)
+                return
+            for caller, callerItems in callers:
+                self.sendError(caller, statusCode, message, isUnsent)
+                answeredCallers.append(caller)
+            return
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            # zephyr applied nothing, the array it refused gets its own answer once posted alone
+            Proxy_Metrics.increment("aggregation.refused")
+            self.requeueUnmerged(callers, answeredCallers)
+            return
+        proxyResponse = CProxyResponse.fromHttpResponse(response)
+        if response.status_code != 200:
+            # throttled or failed, zephyr answered every caller alike
+            for caller, callerItems in callers:
+                self.sendResponse(caller, proxyResponse)
+                answeredCallers.append(caller)
+            return
+        try:
+            replyItems = response.json()
+        except ValueError:
+            replyItems = None
+        if not isinstance(replyItems, list) or len(replyItems) != len(mergedItems):
+            # the merged array is already applied, posting it again would apply it twice,
+            # and the whole reply carries the results of the other callers
+            Proxy_Metrics.increment("aggregation.split_failures")
+            for caller, callerItems in callers:
+                self.sendResponse(caller, CProxyResponse(200, proxyResponse.m_contentType, ""))
+                answeredCallers.append(caller)
+            return
+        offset = 0
+        for caller, callerItems in callers:
+            self.sendResponse(caller, CProxyResponse(200, proxyResponse.m_contentType, json.dumps(replyItems[offset:offset + len(callerItems)])))
+            answeredCallers.append(caller)
+            offset += len(callerItems)
+
+    def requeueUnmerged(self, callers, answeredCallers):
+        '''
+        Queue merged callers again to be posted one by one
+        '''
+        for caller, callerItems in callers:
+            caller.m_isMergeable = False
+            Queue_Container.put(caller)
+            answeredCallers.append(caller)
 
-    def getHttpSession(self):
+    def processBatchRequest(self, content):
         '''
-        Returns current http session[SINGLETON object]
+        Start the items of a BATCH request, the worker finishing the last item answers the client
+        :param content: CRequestData whose body is a JSON array of {"method", "url", "data"} objects
         :return:
         '''
         try:
-            if self._httpSession is None:
-                self._httpSession = requests.session()
-                self._httpSession.headers.update({"Authorization":"%s" %self._authorization, "Content-Type":"%s" %self._contentType })
-            return self._httpSession
+            items = json.loads(content.getRequestBody() or "[]")
+            if not isinstance(items, list):
+                raise ValueError("BATCH body is not a JSON array")
         except Exception as exp:
-            print("Exception in CHttpClass::getHttpSession : %s" %exp)
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(exc_type, exc_obj, exc_tb.tb_lineno)
-            return None
+            self.sendError(content, 400, "Invalid BATCH request : %s" %exp, True)
+            return
+        print ("BATCH of %s items from %s" %(len(items), str(content.m_connectionInfo)))
+        CBatchRequest(content, items, self.sendResponse).start()
 
-    def get(self, requestURL):
+    def sendError(self, content, statusCode, message, isUnsent=False):
         '''
-        Process get http method
-        :param requestURL:
+        Answer a request zephyr did not answer, so the client does not wait for its own timeout
+        :param content: CRequestData
+        :param statusCode:
+        :param message:
+        :param isUnsent: the request never reached zephyr
         :return:
         '''
-        try:
-            print ("CHttpClass : get : %s" %requestURL)
-            response = self.getHttpSession().get(requestURL, timeout=20)
-            return response
-        except Exception as exp:
-            print("Exception in CHttpClass::get : %s" %exp)
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(exc_type, exc_obj, exc_tb.tb_lineno)
-            return None
+        print ("Sending error %s to %s : %s" %(statusCode, str(content.m_connectionInfo), message))
+        Proxy_Metrics.increment("errors.%d" %statusCode)
+        self.sendResponse(content, CProxyResponse.error(statusCode, message, isUnsent))
 
-    def put(self, putURL, values=None):
+    def skipResponse(self, content):
         '''
-        Process put http method
-        :param putURL:
-        :param values:
+        Release the reply slot of an unanswered request so later replies of the connection are not held back
+        :param content:
         :return:
         '''
-        try:
-            print ("CHttpClass : put : %s & values : %s" %(putURL,values))
-            response = self.getHttpSession().put(putURL, data = values, timeout=20)
-            return response
-        except Exception as exp:
-            print("Exception in CHttpClass::put : %s" %exp)
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(exc_type, exc_obj, exc_tb.tb_lineno)
-            return None
+        if content.m_replyHandler is not None:
+            content.m_replyHandler(content, None)
+            return
+        if content.m_responseSequencer is not None:
+            if content.m_sequenceNumber is not None:
+                content.m_responseSequencer.skip(content.m_sequenceNumber)
+            content.m_responseSequencer.release(content)
 
-    def post(self, postURL, values=None):
+    @staticmethod
+    def sendResponse(content, proxyResponse):
         '''
-        Process post http method
-        :param postURL:
-        :param values:
+        Send zephyr reply bytes to the client without parsing them. Static so connection handlers can answer BUSY
+        :param content: CRequestData
+        :param proxyResponse: CProxyResponse
         :return:
         '''
+        if content.m_idempotencyEntry is not None:
+            Idempotency_Table.complete(content, proxyResponse)
+        if content.m_replyHandler is not None:
+            content.m_replyHandler(content, proxyResponse)
+            return
         try:
-            print ("CHttpClass : post : %s & values : %s" %(postURL, values))
-            response = self.getHttpSession().post(postURL, data=values, timeout=20)
-            return response
+            print ("Sending reponse to %s" %str(content.m_connectionInfo))
+
+            if content.m_protocolVersion >= 2:
+                CProcessZephyrRequestThread.sendMessage(content, CProcessZephyrRequestThread.buildFrameV2(content, proxyResponse))
+                return
+
+            encodedMsg = ""
+            if proxyResponse.m_statusCode == 200 and len(proxyResponse.m_body) > 0:
+                '''Encode the message using base64 encoding'''
+                encodedMsg = base64.b64encode(proxyResponse.m_body)
+                print ("Sending %s to %s " %(len(encodedMsg), str(content.m_connectionInfo)))
+
+            # base64 text needs no JSON escaping, the envelope is formatted around it instead of json.dumps copying it again
+            extraFields = ', "requestId": %d' %content.m_requestId if content.m_requestId else ""
+            if proxyResponse.m_error is not None:
+                extraFields += ', "error": %s' %json.dumps(proxyResponse.m_error)
+            if proxyResponse.m_retryAfter is not None:
+                extraFields += ', "retryAfter": %s' %json.dumps(proxyResponse.m_retryAfter)
+            CProcessZephyrRequestThread.sendMessage(content, ['{"len": "%s", "payload": "' %(len(encodedMsg) if encodedMsg else ""), encodedMsg,
+                                       '", "httpStatusCode": %d%s}' %(proxyResponse.m_statusCode, extraFields) + FRAME_DELIMITER])
         except Exception as exp:
-            print("Exception in CHttpClass::post : %s" %exp)
+            print("Exception in CProcessZephyrRequest::sendResponse : %s" %exp)
             exc_type, exc_obj, exc_tb = sys.exc_info()
             print(exc_type, exc_obj, exc_tb.tb_lineno)
-            return None
+            return 
 
+    @staticmethod
+    def buildFrameV2(content, proxyResponse):
+        '''
+        Build a protocol 2 reply : fixed header, meta block with the content type and the zephyr body bytes as received
+        :param content:
+        :param proxyResponse:
+        :return: list of message chunks
+        '''
+        metaData = {}
+        if proxyResponse.m_contentType is not None:
+            metaData["contentType"] = proxyResponse.m_contentType
+        flags = FRAME_V2_FLAG_JSON if proxyResponse.isJSON() else 0
+        if proxyResponse.m_error is not None:
+            flags |= FRAME_V2_FLAG_ERROR
+        if proxyResponse.m_retryAfter is not None:
+            flags |= FRAME_V2_FLAG_BUSY
+            metaData["retryAfter"] = proxyResponse.m_retryAfter
+        meta = json.dumps(metaData) if metaData else ""
+        print ("Sending %s to %s " %(len(proxyResponse.m_body), str(content.m_connectionInfo)))
+        return [FRAME_V2_HEADER.pack(FRAME_V2_MAGIC, FRAME_V2_METHODS.get(content.m_methodType, 0), flags, proxyResponse.m_statusCode,
+                                     content.m_requestId, len(meta), len(proxyResponse.m_body)) + meta, proxyResponse.m_body]
 
+    @staticmethod
+    def sendMessage(content, msg):
 
-class CProcessZephyrRequestThread (threading.Thread):
+        if content.m_responseSequencer is not None and content.m_sequenceNumber is None:
+            content.m_responseSequencer.sendUnordered(msg)
+        elif content.m_responseSequencer is not None:
+            content.m_responseSequencer.send(content.m_sequenceNumber, msg)
+        else:
+            sendAll(content.m_connectionSocket, msg)
+        if content.m_responseSequencer is not None:
+            content.m_responseSequencer.release(content)
+
+class CWriteBehindFlusherThread (threading.Thread):
     '''
-    This class is responsible for processing client request received and queued in shared queue by
-    CReceiverZephyrRequestThread  and sending it's response
-    back to associated clients
+    This class applies the writes of Write_Behind_Journal to zephyr one at a time in journal order. A write zephyr
+    could not take is sent again after a growing delay and later writes wait behind it, writes zephyr refuses
+    are dropped so they do not hold back the others
     '''
     def __init__(self, pthreadID, pthreadName):
         '''
@@ -147,71 +2597,87 @@ class CProcessZephyrRequestThread (threading.Thread):
         '''
         global exitFlag
 
-        try:
-            print ("CProcessZephyrRequest: Starting " + self.m_name)
-            while True:
-                if exitFlag is False:
-                    #print ("Queue : Length : %s" %Queue_Container.qsize())
-                    if Queue_Container.empty() is False:
-                        response = None
-                        content = Queue_Container.get()
-
-                        print ("CProcessZephyrRequest Data : " + ("None" if content.m_httpURL is None else content.m_httpURL))
-                        print ("CProcessZephyrRequest  : %s %s %s" %(content.m_methodType , content.m_connectionInfo[0] , content.m_connectionInfo[1]))
-
-                        if content.m_methodType == "GET":
-                            response = self.m_httpObj.get(content.m_httpURL)
-                        elif (content.m_methodType == "POST"):
-                            response = self.m_httpObj.post(content.m_httpURL, None if (len(content.m_dataPayload) == 0) else (base64.b64decode(content.m_dataPayload)))
-                        elif (content.m_methodType == "PUT"):
-                            response = self.m_httpObj.put(content.m_httpURL, None if (len(content.m_dataPayload) == 0) else (base64.b64decode(content.m_dataPayload))) 
-                        elif (content.m_methodType == "EXIT"):
-                            print ("Closing TCP connection from %s on port number %s" %(content.m_connectionInfo[0], content.m_connectionInfo[1]))
-                            content.socketStatus = False
-                            continue
-                        else:
-                            print ("HTTP METHOD TYPE IS NOT VALID")
-                        if response is None:
-                            print ("No response for content.m_httpURL : %s" %content.m_httpURL)
-                            continue
-                        print ("Response: %s" %response.status_code)
-                        if response.status_code == 200:
-                            self.sendResponse(content.m_connectionInfo, content.m_connectionSocket, response.json(), response.status_code)
-                        else:
-                            self.sendResponse(content.m_connectionInfo, content.m_connectionSocket, None, response.status_code)
-                else:
-                    break
-            print "CProcessZephyrRequest Exiting"
-        except Exception as exp:
-            print("Exception in CProcessZephyrRequest::run : %s" %exp)
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(exc_type, exc_obj, exc_tb.tb_lineno)
-            return
-
-    def sendResponse(self, connectionInfo, connectionSocket, response, status_code):
+        print ("CWriteBehindFlusher: Starting " + self.m_name)
+        retryDelay = WRITE_BEHIND_RETRY_DELAY
+        while exitFlag is False:
+            try:
+                record = Write_Behind_Journal.peek(1.0)
+                if record is None:
+                    continue
+                if self.applyWrite(record):
+                    Write_Behind_Journal.markApplied(record)
+                    retryDelay = WRITE_BEHIND_RETRY_DELAY
+                    continue
+            except Exception as exp:
+                print("Exception in CWriteBehindFlusher::run : %s" %exp)
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                print(exc_type, exc_obj, exc_tb.tb_lineno)
+            Proxy_Metrics.increment("writebehind.retries")
+            time.sleep(retryDelay)
+            retryDelay = min(WRITE_BEHIND_MAX_RETRY_DELAY, retryDelay * 2)
+        # writes still pending stay in the journal and are applied after the restart
+        print ("CWriteBehindFlusher Exiting " + self.m_name)
 
-        try:
-            print ("Sending reponse to %s" %str(connectionInfo))
+    def applyWrite(self, record):
+        '''
+        Send one journaled write to zephyr
+        :param record: journal record
+        :return: False when zephyr did not take the write and it must be sent again
+        '''
+        body = None if record["body"] is None else base64.b64decode(record["body"])
+        if record["method"] == "POST":
+            response = self.m_httpObj.post(record["url"], body)
+        else:
+            response = self.m_httpObj.put(record["url"], body)
+        if response is None or response.status_code >= 500 or response.status_code == 429:
+            print ("Journaled write %s not applied : %s" %(record["sequence"],
+                                                            self.m_httpObj.getLastError() if response is None else response.status_code))
+            return False
+        Response_Cache.invalidate(record["url"])
+        if response.status_code >= 400:
+            print ("Journaled write %s refused by zephyr with %s : %s" %(record["sequence"], response.status_code, record["url"]))
+            Proxy_Metrics.increment("writebehind.refused")
+        else:
+            Proxy_Metrics.increment("writebehind.applied")
+        return True
 
-            msgLength = ""
-            encodedMsg = ""
-            if response is not None:
-                responseData = json.dumps(response)
-                #print (responseData)
+class CBusyReplyThread (threading.Thread):
+    '''
+    This class sends the BUSY replies of requests refused by CConnectionHandler::queueRequest, so the thread reading
+    client sockets never writes to one. It stays apart from the dispatcher workers which are all busy when the queue is full.
+    A client which stops reading blocks it until the client is disconnected for exceeding CONNECTION_MAX_BUSY_REPLIES
+    '''
+    def __init__(self, pthreadID, pthreadName):
+        '''
+        Initializing base class(thread) and class member variables
+        :param pthreadID:
+        :param pthreadName:
+        '''
+        threading.Thread.__init__(self)
+        self.m_threadID           = pthreadID
+        self.m_name               = pthreadName
 
-                '''Encode the message using base64 encoding'''
-                encodedMsg = base64.b64encode(responseData)
-                msgLength = len(encodedMsg)
-                print ("Sending %s to %s " %(len(encodedMsg), str(connectionInfo)))
+    def run(self):
+        '''
+        Thread callback function
+        :return:
+        '''
+        global exitFlag
 
-            jsonData = {"len": str(msgLength), "payload": encodedMsg, "httpStatusCode": status_code}
-            msg = json.dumps(jsonData)
-            connectionSocket.send(msg + "#####")
-        except Exception as exp:
-            print("Exception in CProcessZephyrRequest::sendResponse : %s" %exp)
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(exc_type, exc_obj, exc_tb.tb_lineno)
-            return 
+        print ("CBusyReply: Starting " + self.m_name)
+        while exitFlag is False:
+            try:
+                content, proxyResponse = Busy_Reply_Queue.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            try:
+                CProcessZephyrRequestThread.sendResponse(content, proxyResponse)
+            except Exception as exp:
+                print("Exception in CBusyReply::run : %s" %exp)
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                print(exc_type, exc_obj, exc_tb.tb_lineno)
+            content.m_responseSequencer.releaseBusyReply()
+        print ("CBusyReply Exiting " + self.m_name)
 
 class CTCPSocket:
 
@@ -235,14 +2701,14 @@ class CTCPSocket:
                 connection, address = self.sock.accept()
                 print ("Accepting connection from " + str(address))
                 socketThread = ThreadDelegate(address, connection)
+                # ThreadDelegates are tracked by Connection_Manager and dropped once reaped, not kept in threadList
+                Connection_Manager.register(socketThread)
                 socketThread.start()
-                threadList.append(socketThread)
         except Exception as exp:
             print("Exception in CTCPSocket::StartServerConnection : %s" %exp)
             exc_type, exc_obj, exc_tb = sys.exc_info()
             print(exc_type, exc_obj, exc_tb.tb_lineno)
-            for t in threadList:
-                t.close()
+            Connection_Manager.reapAll("shutdown")
             self.close()
             return 
 
@@ -250,55 +2716,428 @@ class CTCPSocket:
         self.sock.close()
 
 
-class ThreadDelegate(threading.Thread):
+class CEventLoopTCPSocket(CTCPSocket):
+    '''
+    This class serves every client connection from a single select/epoll loop instead of
+    spawning one ThreadDelegate per accepted socket. The wire protocol is unchanged.
+    '''
+    def __init__(self, pIPAddress, pPortNumber):
+        '''
+        Initializing base class(listening socket) and the readiness poller
+        :param pIPAddress:
+        :param pPortNumber:
+        '''
+        CTCPSocket.__init__(self, pIPAddress, pPortNumber)
+        self.sock.setblocking(0)
+        self.m_connections      = {}
+        self.m_poller           = select.epoll() if hasattr(select, "epoll") else None
+
+    def StartServerConnection(self, threadList):
+        '''
+        Event loop : accepts new clients and reads every ready client socket until exitFlag is set
+        :param threadList: unused, kept for interface compatibility with CTCPSocket
+        :return:
+        '''
+        try:
+            self.register(self.sock.fileno())
+            while exitFlag is False:
+                for fileNo in self.poll(EVENT_LOOP_POLL_TIMEOUT):
+                    if fileNo == self.sock.fileno():
+                        self.acceptConnections()
+                    elif fileNo in self.m_connections:
+                        self.readConnection(self.m_connections[fileNo])
+        except Exception as exp:
+            print("Exception in CEventLoopTCPSocket::StartServerConnection : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+        for connection in self.m_connections.values():
+            self.closeConnection(connection, "shutdown")
+        self.close()
+
+    def register(self, fileNo):
+
+        if self.m_poller is not None:
+            self.m_poller.register(fileNo, select.EPOLLIN)
+
+    def unregister(self, fileNo):
+
+        if self.m_poller is not None:
+            try:
+                self.m_poller.unregister(fileNo)
+            except (IOError, OSError):
+                # socket was already closed by the request parser, epoll dropped it by itself
+                pass
+
+    def poll(self, timeout):
+        '''
+        Returns file numbers of sockets ready for reading
+        :param timeout:
+        :return:
+        '''
+        if self.m_poller is not None:
+            return [fileNo for fileNo, event in self.m_poller.poll(timeout)]
+        readyList, writeList, errorList = select.select([self.sock.fileno()] + self.m_connections.keys(), [], [], timeout)
+        return readyList
+
+    def acceptConnections(self):
+        '''
+        Accept every pending client on the non-blocking listening socket
+        :return:
+        '''
+        while True:
+            try:
+                connection, address = self.sock.accept()
+            except socket.error:
+                return
+            print ("Accepting connection from " + str(address))
+            # Client sockets stay blocking : select guarantees recv won't block and dispatchers use plain send
+            connection.setblocking(1)
+            eventLoopConnection = CEventLoopConnection(address, connection)
+            Connection_Manager.register(eventLoopConnection)
+            self.m_connections[eventLoopConnection.m_fileNo] = eventLoopConnection
+            self.register(eventLoopConnection.m_fileNo)
+
+    def readConnection(self, connection):
+        '''
+        Read available bytes of one client and close it on EOF, reset or exit message
+        :param connection:
+        :return:
+        '''
+        try:
+            data = connection.connectionSocket.recv(SOCKET_RECV_SIZE)
+        except socket.error as exp:
+            print ("Connection reset by %s : %s" %(str(connection.connectionInfo), exp))
+            self.closeConnection(connection, "reset")
+            return
+        if not data:
+            self.closeConnection(connection, "eof")
+            return
+        reason = connection.processData(data)
+        if reason is not None:
+            self.closeConnection(connection, reason)
+
+    def closeConnection(self, connection, reason):
+
+        if connection.m_fileNo in self.m_connections:
+            del self.m_connections[connection.m_fileNo]
+            self.unregister(connection.m_fileNo)
+        Connection_Manager.reap(connection, reason)
+
+
+class CParsedFrame:
+    '''
+    This class stores one complete client frame returned by CFrameParser
+    '''
+    def __init__(self, protocolVersion, methodType, text=None, requestId=0, flags=0, meta=None, body=None):
+        '''
+        Initializing class member variables
+        :param protocolVersion:
+        :param methodType: EXIT for close messages, None for protocol 1 JSON requests
+        :param text: JSON text of a protocol 1 request
+        :param requestId:
+        :param flags:
+        :param meta:
+        :param body:
+        '''
+        self.m_protocolVersion  = protocolVersion
+        self.m_methodType       = methodType
+        self.m_text             = text
+        self.m_requestId        = requestId
+        self.m_flags            = flags
+        self.m_meta             = meta
+        self.m_body             = body
+
+class CFrameParserError(Exception):
+    pass
+
+class CFrameParser:
+    '''
+    This class incrementally splits client socket data into frames. Data is appended to one bytearray,
+    every complete frame is returned (several frames coalesced in one recv are no longer dropped) and a
+    partial tail waits for the next recv. Consumed bytes are trimmed only once they make up half of the
+    buffer, so large bodies split over many recv calls cost linear time.
+    '''
+    def __init__(self, protocolVersion=1):
+        '''
+        Initializing class member variables
+        :param protocolVersion: 1 : ##### delimited JSON, 2 : FRAME_V2_HEADER length prefixed frames
+        '''
+        self.m_protocolVersion  = protocolVersion
+        self.m_buffer           = bytearray()
+        self.m_readOffset       = 0
+        self.m_scanOffset       = 0
+
+    def setProtocolVersion(self, protocolVersion):
+        '''
+        Switch framing, takes effect with the next frame returned by nextFrame
+        '''
+        self.m_protocolVersion = protocolVersion
+
+    def feed(self, data):
+
+        self.m_buffer.extend(data)
+
+    def pendingLength(self):
+
+        return len(self.m_buffer) - self.m_readOffset
+
+    def nextFrame(self):
+        '''
+        Returns the next complete frame, None when more data is needed
+        :return: CParsedFrame
+        '''
+        if self.m_protocolVersion >= 2:
+            frame = self.nextFrameV2()
+        else:
+            frame = self.nextFrameV1()
+        self.compact()
+        return frame
+
+    def nextFrameV1(self):
+
+        delimiterIndex = self.m_buffer.find(FRAME_DELIMITER, max(self.m_readOffset, self.m_scanOffset))
+        if delimiterIndex < 0:
+            # Resume the next search where a delimiter split over two recv calls could start
+            self.m_scanOffset = max(self.m_readOffset, len(self.m_buffer) - len(FRAME_DELIMITER) + 1)
+            if self.pendingLength() > MAX_FRAME_BYTES:
+                raise CFrameParserError("Protocol 1 frame exceeds %d bytes" %MAX_FRAME_BYTES)
+            # Legacy close messages are not delimited, only the unparsed tail is compared
+            if self.pendingLength() == len(FRAME_EXIT_MESSAGE) and self.m_buffer.endswith(FRAME_EXIT_MESSAGE):
+                self.m_readOffset = len(self.m_buffer)
+                return CParsedFrame(1, "EXIT")
+            elif self.m_buffer.endswith("-exit"):
+                raise CFrameParserError("Invalid request")
+            return None
+        text = memoryview(self.m_buffer)[self.m_readOffset:delimiterIndex].tobytes()
+        self.m_readOffset = delimiterIndex + len(FRAME_DELIMITER)
+        self.m_scanOffset = self.m_readOffset
+        return CParsedFrame(1, None, text)
+
+    def nextFrameV2(self):
+
+        if self.pendingLength() < FRAME_V2_HEADER.size:
+            return None
+        magic, methodCode, flags, status, requestId, metaLength, bodyLength = FRAME_V2_HEADER.unpack_from(self.m_buffer, self.m_readOffset)
+        if magic != FRAME_V2_MAGIC or methodCode not in FRAME_V2_METHOD_NAMES:
+            raise CFrameParserError("Invalid protocol 2 frame")
+        if metaLength + bodyLength > MAX_FRAME_BYTES:
+            # the lengths are checked before anything is buffered for them
+            raise CFrameParserError("Protocol 2 frame of %d bytes exceeds %d bytes" %(metaLength + bodyLength, MAX_FRAME_BYTES))
+        metaOffset = self.m_readOffset + FRAME_V2_HEADER.size
+        bodyOffset = metaOffset + metaLength
+        frameEnd = bodyOffset + bodyLength
+        if len(self.m_buffer) < frameEnd:
+            return None
+        view = memoryview(self.m_buffer)
+        frame = CParsedFrame(2, FRAME_V2_METHOD_NAMES[methodCode], None, requestId, flags,
+                             view[metaOffset:bodyOffset].tobytes(), view[bodyOffset:frameEnd].tobytes())
+        del view
+        self.m_readOffset = frameEnd
+        return frame
+
+    def compact(self):
+        '''
+        Drop consumed bytes once they are at least half of the buffer
+        '''
+        if self.m_readOffset > 0 and self.m_readOffset * 2 >= len(self.m_buffer):
+            del self.m_buffer[:self.m_readOffset]
+            self.m_scanOffset = max(0, self.m_scanOffset - self.m_readOffset)
+            self.m_readOffset = 0
 
+class CConnectionHandler:
+    '''
+    This class holds per client connection state and queues parsed client requests
+    '''
     def __init__(self, connectionInfo, connectionSocket):
 
-        threading.Thread.__init__(self)
         self.connectionInfo = connectionInfo
         self.connectionSocket = connectionSocket
         self.data = ""
         self.socketStatus = True
+        self.responseSequencer = CResponseSequencer(connectionSocket)
+        self.protocolVersion = 1
+        self.frameParser = CFrameParser(self.protocolVersion)
+
+    def processData(self, data):
+        '''
+        Queue every complete frame received so far
+        :param data: bytes returned by recv
+        :return: None to keep reading, otherwise the reason to close the connection (exit, invalid or overloaded)
+        '''
+        self.frameParser.feed(data)
+        try:
+            while True:
+                frame = self.frameParser.nextFrame()
+                if frame is None:
+                    return None
+                if frame.m_methodType == "EXIT":
+                    self.insertParsedData("exit")
+                    return "exit"
+                if frame.m_protocolVersion >= 2:
+                    reason = self.insertFrameV2(frame)
+                else:
+                    print ("+++++Complete Data : %s %s" %(frame.m_text, len(frame.m_text)))
+                    reason = self.insertParsedData(frame.m_text)
+                if reason is not None:
+                    return reason
+        except CFrameParserError as exp:
+            print ("ERROR : %s from %s" %(exp, str(self.connectionInfo)))
+            return "invalid"
+
+    def insertParsedData(self, msg):
+        '''
+        Queue one protocol 1 request
+        :param msg: JSON request text, or exit for a close message
+        :return: None when queued, otherwise the reason to close the connection (invalid or overloaded)
+        '''
+        print ("Parsed data: %s" %msg)
+
+        try:
+            if(msg == "exit"):
+                print "Sending connection close message to Queue for processing"
+                l_payload = CRequestData("EXIT", None, None, self.connectionInfo, self.connectionSocket, self.socketStatus,
+                                         self.responseSequencer)
+            else:
+                data = json.loads(msg)
+                if data["method"] == "HELLO":
+                    self.negotiateProtocol(data)
+                    return
+                l_payload = CRequestData(data["method"], data["url"], data["data"], self.connectionInfo, self.connectionSocket, self.socketStatus,
+                                         self.responseSequencer, requestId=int(data.get("requestId", 0)), priority=data.get("priority"),
+                                         deadline=data.get("deadline"), idempotencyKey=data.get("idempotencyKey"))
+                return self.queueRequest(l_payload)
+
+            '''
+            Queue the data for further processing by CProcessZephyrRequestThread
+            '''
+            Queue_Container.put(l_payload)
+        except Exception as exp:
+            print("Exception in CConnectionHandler::insertParsedData : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return "invalid"
+
+    def negotiateProtocol(self, data):
+        '''
+        Answer a HELLO request with the framing version used for the rest of the connection.
+        Clients which never send HELLO keep the ##### delimited protocol 1
+        :param data: HELLO request carrying the highest protocol version known by the client
+        :return:
+        '''
+        self.protocolVersion = max(1, min(int(data.get("protocol", 1)), FRAME_PROTOCOL_VERSION))
+        self.frameParser.setProtocolVersion(self.protocolVersion)
+        print ("Protocol version %s negotiated with %s" %(self.protocolVersion, str(self.connectionInfo)))
+        # idempotency tells the client resent writes are answered from Idempotency_Table instead of applied again,
+        # batch that BATCH requests are understood
+        msg = json.dumps({"len": "", "payload": "", "httpStatusCode": 200, "protocol": self.protocolVersion, "idempotency": True,
+                          "batch": self.protocolVersion >= 2})
+        # the client sends nothing else before this reply, it needs no reply slot
+        self.responseSequencer.sendUnordered(msg + FRAME_DELIMITER)
+
+    def insertFrameV2(self, frame):
+        '''
+        Queue one protocol 2 request, the meta block is a JSON object carrying the url
+        :param frame: CParsedFrame
+        :return: None when queued, otherwise the reason to close the connection (invalid or overloaded)
+        '''
+        try:
+            metaData = json.loads(frame.m_meta)
+            print ("Parsed frame: %s %s %s bytes" %(frame.m_methodType, metaData["url"], len(frame.m_body)))
+            return self.queueRequest(CRequestData(frame.m_methodType, metaData["url"], frame.m_body, self.connectionInfo, self.connectionSocket,
+                                                  self.socketStatus, self.responseSequencer, self.protocolVersion, frame.m_requestId,
+                                                  priority=metaData.get("priority"), deadline=metaData.get("deadline"),
+                                                  idempotencyKey=metaData.get("idempotencyKey")))
+        except Exception as exp:
+            print("Exception in CConnectionHandler::insertFrameV2 : %s" %exp)
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            print(exc_type, exc_obj, exc_tb.tb_lineno)
+            return "invalid"
+
+    def queueRequest(self, content):
+        '''
+        Queue a client request for CProcessZephyrRequestThread, or hand a BUSY reply to CBusyReplyThread when the
+        connection has CONNECTION_MAX_IN_FLIGHT requests queued or running or when the proxy queue is full
+        :param content: CRequestData
+        :return: None, overloaded when the client must be disconnected because its BUSY replies can not be queued
+        '''
+        if not self.responseSequencer.admit(content, CONNECTION_MAX_IN_FLIGHT):
+            Proxy_Metrics.increment("busy.connection_in_flight")
+            return self.queueBusyReply(content, CProxyResponse.busy("Too many requests in flight on this connection", CONNECTION_BUSY_RETRY_AFTER))
+        elif not Queue_Container.tryPut(content):
+            self.responseSequencer.release(content)
+            Proxy_Metrics.increment("busy.queue_full")
+            return self.queueBusyReply(content, CProxyResponse.busy("Zephyr proxy queue is full", QUEUE_FULL_RETRY_AFTER))
+        return None
+
+    def queueBusyReply(self, content, proxyResponse):
+        '''
+        Hand a BUSY reply to CBusyReplyThread, the body of the refused request is dropped first
+        :param content: CRequestData
+        :param proxyResponse: BUSY reply
+        :return: None, overloaded when the connection has CONNECTION_MAX_BUSY_REPLIES waiting or Busy_Reply_Queue is full
+        '''
+        content.m_dataPayload = None
+        if self.responseSequencer.admitBusyReply(CONNECTION_MAX_BUSY_REPLIES):
+            try:
+                Busy_Reply_Queue.put((content, proxyResponse), False)
+                return None
+            except Queue.Full:
+                self.responseSequencer.releaseBusyReply()
+        print ("BUSY replies to %s can not be queued, disconnecting" %str(self.connectionInfo))
+        Proxy_Metrics.increment("busy.disconnects")
+        return "overloaded"
+
+    def close(self):
+        try:
+            # wakes a thread blocked writing to a client which stopped reading
+            self.connectionSocket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.connectionSocket.close()
+
+
+class CEventLoopConnection(CConnectionHandler):
+    '''
+    This class holds socket state of one client served by CEventLoopTCPSocket
+    '''
+    def __init__(self, connectionInfo, connectionSocket):
+
+        CConnectionHandler.__init__(self, connectionInfo, connectionSocket)
+        self.m_fileNo = connectionSocket.fileno()
+
+
+class ThreadDelegate(threading.Thread, CConnectionHandler):
+
+    def __init__(self, connectionInfo, connectionSocket):
 
-    def rchop(self, thestring, ending):
-        if thestring.endswith(ending):
-            return thestring[:-len(ending)]
-        return thestring
+        threading.Thread.__init__(self)
+        CConnectionHandler.__init__(self, connectionInfo, connectionSocket)
 
     def run(self):
 
+        reason = None
         try:
 
-            completeData = ""
-            while self.socketStatus is True:
-                data = self.connectionSocket.recv(8096)
-                if not data:
-                    continue
-                elif "####" in data:
-                    dataString = self.rchop(data, "#####")
-                    completeData = completeData + dataString
-                    print ("+++++Complete Data : %s %s" %(completeData, len(completeData)))
-                    self.insertParsedData(completeData)
-                    completeData = ""
-                elif data == "\"exit\"":
-                    #self.parseSocketData(data)
-                    self.insertParsedData("exit")
+            while self.socketStatus is True and reason is None:
+                try:
+                    data = self.connectionSocket.recv(SOCKET_RECV_SIZE)
+                except socket.error as exp:
+                    print ("Connection reset by %s : %s" %(str(self.connectionInfo), exp))
+                    reason = "reset"
                     break
-                elif "-exit" in data:
-                    print ("ERROR : Invalid request")
+                if not data:
+                    # Peer closed its side : recv would keep returning "" immediately
+                    reason = "eof"
                     break
-                else:
-                    completeData = completeData + data
-                    print ("Data : %s %s" %(data, len(data)))
-                    print ("++++In-Progress Data : %s %s" %(completeData, len(completeData)))
+                reason = self.processData(data)
 
             print ("Thread execution completed successfully")
-            self.close()
+            Connection_Manager.reap(self, reason or "exit")
         except Exception as exp:
             print("Exception in ThreadDelegate::run : %s" %exp)
             exc_type, exc_obj, exc_tb = sys.exc_info()
             print(exc_type, exc_obj, exc_tb.tb_lineno)
-            self.close()
+            Connection_Manager.reap(self, "error")
 
     def parseSocketData(self, data):
 
@@ -331,36 +3170,11 @@ class ThreadDelegate(threading.Thread):
         else:
             self.data = self.data + data
 
-    def insertParsedData(self, msg):
-
-        print ("Parsed data: %s" %msg)
-
-        try:
-            if(msg == "exit"):
-                print "Sending connection close message to Queue for processing"
-                l_payload = CRequestData("EXIT", None, None, self.connectionInfo, self.connectionSocket, self.socketStatus)
-            else:
-                data = json.loads(msg)
-                l_payload = CRequestData(data["method"], data["url"], data["data"], self.connectionInfo, self.connectionSocket, self.socketStatus)
-
-            '''
-            Queue the data for further processing by CProcessZephyrRequestThread
-            '''
-            Queue_Container.put(l_payload)
-        except Exception as exp:
-            print("Exception in ThreadDelegate::run : %s" %exp)
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print(exc_type, exc_obj, exc_tb.tb_lineno)
-            self.connectionSocket.close()
-
     def printQueueData(self):
 
         if (Queue_Container.qsize() <= 0):
             print ("Data is Queue : %s" %(Queue_Container.qsize()))
 
-    def close(self):
-        self.connectionSocket.close()
-
 
 class UserInput  (threading.Thread):
     '''
@@ -386,6 +3200,8 @@ class UserInput  (threading.Thread):
 
         while True:
             self.printQueueData()
+            Upstream_Pool.evictIdle()
+            self.printProxyMetrics()
             if exitFlag is False:
                 if (os.path.isfile("./userInput.txt") is True):
                     fp = open("./userInput.txt", "r")
@@ -394,6 +3210,9 @@ class UserInput  (threading.Thread):
 
                     if 'exit' in fileContent:
                         exitFlag = True
+                        # Wake up every dispatcher worker blocked on the empty queue
+                        for workerIndex in range(0, DISPATCHER_WORKER_COUNT):
+                            Queue_Container.put(None)
             else:
                 break
             time.sleep(30)
@@ -404,18 +3223,33 @@ class UserInput  (threading.Thread):
             print ("=======================Queue Size : %s" %(Queue_Container.qsize()))
         #print ("=======================ThreadContainer Size : %s" %(len(threadList)))
 
+    def printProxyMetrics(self):
+
+        print ("=======================Proxy Metrics : %s" %json.dumps(Proxy_Metrics.snapshot(), sort_keys=True))
+
 def main():
 
-    zephyrInterface = CProcessZephyrRequestThread(1234, "ZephyrProcess")
+    dispatcherList = []
+    for workerIndex in range(0, DISPATCHER_WORKER_COUNT):
+        dispatcherList.append(CProcessZephyrRequestThread(1234 + workerIndex, "ZephyrProcess-%d" %workerIndex))
     thread3 = UserInput(5678, "User Input Thread")
+    if WRITE_BEHIND_ENABLED:
+        # writes acknowledged by the previous run go to zephyr before any new one
+        Write_Behind_Journal.recover()
+        dispatcherList.append(CWriteBehindFlusherThread(5679, "Write Behind Flusher"))
+    dispatcherList.append(CBusyReplyThread(5680, "Busy Reply Thread"))
 
-    zephyrInterface.start()
+    for zephyrInterface in dispatcherList:
+        zephyrInterface.start()
     thread3.start()
 
-    sockObj = CTCPSocket("127.0.0.1", SERVER_LISTEN_PORT)
+    if SERVER_ENGINE == "eventloop":
+        sockObj = CEventLoopTCPSocket("127.0.0.1", SERVER_LISTEN_PORT)
+    else:
+        sockObj = CTCPSocket("127.0.0.1", SERVER_LISTEN_PORT)
     sockObj.StartServerConnection(threadList)
 
-    threadList.append(zephyrInterface)
+    threadList.extend(dispatcherList)
     threadList.append(thread3)
     for t in threadList:
         t.join()
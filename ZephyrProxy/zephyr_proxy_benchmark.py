@@ -0,0 +1,260 @@
+'''
+Synopsis:
+        Benchmark of the zephyr proxy server engines. For every engine the proxy is started in a child
+        process in front of a local fake zephyr server, idle client connections are opened to measure
+        connections per GB of proxy memory and then requests are sent to measure round trip latency.
+        With --parser the client frame parser is fuzzed with randomly split streams and its throughput is measured.
+
+        python zephyr_proxy_benchmark.py --connections 500 --requests 20
+        python zephyr_proxy_benchmark.py --parser
+'''
+import sys
+import os
+import json
+import time
+import random
+import base64
+import socket
+import argparse
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+PROXY_DIR                   = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_ENGINES           = ["threaded", "eventloop"]
+FRAME_DELIMITER             = "#####"
+FAKE_ZEPHYR_RESPONSE        = json.dumps({"id": 1, "name": "benchmark", "steps": [{"id": i} for i in range(50)]})
+
+class CFakeZephyrHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    This class answers every request with a fixed JSON document
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(FAKE_ZEPHYR_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(FAKE_ZEPHYR_RESPONSE)
+
+    def log_message(self, format, *args):
+        return
+
+class CFakeZephyrServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+def startFakeZephyr():
+    '''
+    Start the fake zephyr server on a free port
+    :return: server object
+    '''
+    server = CFakeZephyrServer(("127.0.0.1", 0), CFakeZephyrHandler)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    return server
+
+def getFreePort():
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def startProxy(engine, port):
+    '''
+    Start the proxy with given server engine in a child process and wait until it listens
+    :param engine:
+    :param port:
+    :return: child process and the socket used to probe the listening port
+    '''
+    # Cached and coalesced GETs would be answered without reaching the dispatcher workers and the fake zephyr
+    script = ("import zephyr_proxy; zephyr_proxy.SERVER_ENGINE = %r; zephyr_proxy.SERVER_LISTEN_PORT = %d; "
+              "zephyr_proxy.RESPONSE_CACHE_ENABLED = False; zephyr_proxy.SINGLE_FLIGHT_ENABLED = False; zephyr_proxy.main()" %(engine, port))
+    devNull = open(os.devnull, "w")
+    process = subprocess.Popen([sys.executable, "-c", script], cwd=PROXY_DIR, stdout=devNull, stderr=devNull)
+    for count in range(0, 100):
+        try:
+            # The probe stays open until the run ends so it is not reaped in the middle of the memory measurement
+            return process, socket.create_connection(("127.0.0.1", port), 1)
+        except socket.error:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Proxy with %s engine did not start" %engine)
+
+def readProcessStatus(pid):
+    '''
+    Returns resident memory in bytes and thread count of a process
+    :param pid:
+    :return:
+    '''
+    status = {}
+    fp = open("/proc/%d/status" %pid, "r")
+    for line in fp:
+        key, value = line.split(":", 1)
+        status[key] = value.strip()
+    fp.close()
+    return int(status["VmRSS"].split()[0]) * 1024, int(status["Threads"])
+
+def sendRequest(sock, url):
+    '''
+    Send one GET request using the proxy wire protocol and wait for its reply
+    :param sock:
+    :param url:
+    :return: round trip time in seconds
+    '''
+    startTime = time.time()
+    sock.sendall(json.dumps({"url": url, "method": "GET", "data": ""}) + FRAME_DELIMITER)
+    data = ""
+    while FRAME_DELIMITER not in data:
+        recvData = sock.recv(65536)
+        if not recvData:
+            raise RuntimeError("Proxy closed the connection")
+        data = data + recvData
+    return time.time() - startTime
+
+def percentile(values, percent):
+
+    orderedValues = sorted(values)
+    index = min(len(orderedValues) - 1, int(round(percent / 100.0 * (len(orderedValues) - 1))))
+    return orderedValues[index]
+
+def runEngineBenchmark(engine, connectionCount, requestCount, activeClients, url):
+    '''
+    Measure memory per connection and request latency of one server engine
+    :return: result dictionary
+    '''
+    port = getFreePort()
+    process, probeSocket = startProxy(engine, port)
+    connections = []
+    try:
+        time.sleep(0.5)
+        baseMemory, baseThreads = readProcessStatus(process.pid)
+        for count in range(0, connectionCount):
+            connections.append(socket.create_connection(("127.0.0.1", port)))
+        time.sleep(1)
+        loadedMemory, loadedThreads = readProcessStatus(process.pid)
+
+        latencies = []
+        latencyLock = threading.Lock()
+
+        def clientWorker(sock):
+            clientLatencies = [sendRequest(sock, url) for count in range(0, requestCount)]
+            with latencyLock:
+                latencies.extend(clientLatencies)
+
+        workers = [threading.Thread(target=clientWorker, args=(sock,)) for sock in connections[:activeClients]]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        memoryPerConnection = max(1, loadedMemory - baseMemory) / float(connectionCount)
+        return {"engine": engine,
+                "connections": connectionCount,
+                "threads": loadedThreads,
+                "memoryPerConnection": memoryPerConnection,
+                "connectionsPerGB": (1024 ** 3) / memoryPerConnection,
+                "p50": percentile(latencies, 50) * 1000,
+                "p99": percentile(latencies, 99) * 1000}
+    finally:
+        for sock in connections + [probeSocket]:
+            sock.close()
+        process.kill()
+        process.wait()
+
+def buildParserStream(protocolVersion, frameCount, randomGenerator):
+    '''
+    Build a byte stream of random client frames
+    :return: stream and list of expected (method, request id, text or body) tuples
+    '''
+    import zephyr_proxy
+    chunks = []
+    expected = []
+    for requestId in range(1, frameCount + 1):
+        # Bodies deliberately contain the protocol 1 delimiter and binary bytes
+        body = "".join(chr(randomGenerator.randint(0, 255)) for count in range(randomGenerator.randint(0, 300))) + FRAME_DELIMITER
+        if protocolVersion >= 2:
+            meta = json.dumps({"url": "/execution/%d" %requestId})
+            chunks.append(zephyr_proxy.FRAME_V2_HEADER.pack(zephyr_proxy.FRAME_V2_MAGIC, zephyr_proxy.FRAME_V2_METHODS["PUT"], 0, 0,
+                                                            requestId, len(meta), len(body)) + meta + body)
+            expected.append(("PUT", requestId, body))
+        else:
+            text = json.dumps({"url": "/execution/%d" %requestId, "method": "PUT", "data": base64.b64encode(body)})
+            chunks.append(text + FRAME_DELIMITER)
+            expected.append((None, 0, text))
+    return "".join(chunks), expected
+
+def parseStream(parser, stream, cutPoints):
+    '''
+    Feed stream to parser split at cutPoints
+    :return: list of (method, request id, text or body) tuples
+    '''
+    frames = []
+    previousCut = 0
+    for cut in cutPoints + [len(stream)]:
+        parser.feed(stream[previousCut:cut])
+        previousCut = cut
+        frame = parser.nextFrame()
+        while frame is not None:
+            frames.append((frame.m_methodType, frame.m_requestId, frame.m_body if frame.m_protocolVersion >= 2 else frame.m_text))
+            frame = parser.nextFrame()
+    return frames
+
+def runParserBenchmark(iterations):
+    '''
+    Fuzz CFrameParser with randomly split and coalesced streams and measure its throughput
+    '''
+    import zephyr_proxy
+    randomGenerator = random.Random(1234)
+    for protocolVersion in [1, 2]:
+        for iteration in range(0, iterations):
+            stream, expected = buildParserStream(protocolVersion, randomGenerator.randint(1, 20), randomGenerator)
+            cutPoints = sorted(randomGenerator.sample(xrange(1, len(stream)), min(len(stream) - 1, randomGenerator.randint(0, 40))))
+            frames = parseStream(zephyr_proxy.CFrameParser(protocolVersion), stream, cutPoints)
+            if frames != expected:
+                raise AssertionError("Protocol %d stream %d parsed into %d frames instead of %d" %(protocolVersion, iteration, len(frames), len(expected)))
+        print ("protocol %d : %d randomly split streams parsed correctly" %(protocolVersion, iterations))
+
+    bigBody = base64.b64encode(os.urandom(30 * 1024 * 1024))
+    bigFrame = json.dumps({"url": "/execution/1", "method": "PUT", "data": bigBody}) + FRAME_DELIMITER
+    smallStream, expected = buildParserStream(1, 20000, randomGenerator)
+    for name, stream in [("one %d MB frame" %(len(bigFrame) / (1024 * 1024)), bigFrame), ("%d small frames" %len(expected), smallStream)]:
+        startTime = time.time()
+        frames = parseStream(zephyr_proxy.CFrameParser(1), stream, range(65536, len(stream), 65536))
+        elapsed = time.time() - startTime
+        print ("protocol 1 : %-22s %8.1f MB/s %10d frames/s" %(name, len(stream) / elapsed / (1024 * 1024), len(frames) / elapsed))
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Zephyr proxy server engine benchmark")
+    parser.add_argument("--connections", type=int, default=500, help="idle client connections to open")
+    parser.add_argument("--requests", type=int, default=20, help="requests sent by each active client")
+    parser.add_argument("--active", type=int, default=50, help="clients sending requests for the latency run")
+    parser.add_argument("--engines", default=",".join(BENCHMARK_ENGINES), help="comma separated server engines")
+    parser.add_argument("--parser", action="store_true", help="fuzz and measure the client frame parser instead")
+    parser.add_argument("--iterations", type=int, default=500, help="random streams parsed per protocol by --parser")
+    args = parser.parse_args()
+
+    if args.parser:
+        runParserBenchmark(args.iterations)
+        return
+
+    fakeZephyr = startFakeZephyr()
+    url = "http://127.0.0.1:%d/flex/services/rest/latest/project/" %fakeZephyr.server_address[1]
+
+    print ("%-10s %12s %8s %16s %18s %10s %10s" %("engine", "connections", "threads", "bytes/connection", "connections/GB", "p50(ms)", "p99(ms)"))
+    for engine in args.engines.split(","):
+        result = runEngineBenchmark(engine, args.connections, args.requests, min(args.active, args.connections), url)
+        print ("%-10s %12d %8d %16d %18d %10.2f %10.2f" %(result["engine"], result["connections"], result["threads"],
+                                                        result["memoryPerConnection"], result["connectionsPerGB"],
+                                                        result["p50"], result["p99"]))
+    fakeZephyr.shutdown()
+
+if __name__ == "__main__":
+    main()